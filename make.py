@@ -1,16 +1,40 @@
 #!/usr/bin/env python2
 # -*- coding: utf-8 -*-
 
-from os import path, linesep, getcwd, chdir, system
-from os import symlink, unlink, makedirs, listdir
+from os import path, linesep, sep, getcwd, chdir
+from os import symlink, unlink, makedirs, listdir, rename, stat, walk
+from os import devnull, environ
+from os import times as os_times
 from collections import Iterable as Iter, OrderedDict
+from multiprocessing import cpu_count, Process, Pipe
+from threading import Thread, Timer, Lock, RLock, Event, current_thread
+from subprocess import Popen, PIPE, STDOUT
+from traceback import format_exc
+from codecs import getincrementaldecoder
 from datetime import datetime
 from sys import version_info
 from shutil import rmtree, copy2
-from time import sleep
+from time import sleep, time, mktime
+from tempfile import mkdtemp
 import argparse
+import atexit
+import hashlib
+import json
+import shlex
+import signal
+import socket
 import sys
 import re
+try:  # Not available on Windows
+    from os import killpg, setsid, wait4
+    from os import WIFEXITED, WEXITSTATUS, WTERMSIG
+    from resource import getrusage, RUSAGE_SELF
+except ImportError:
+    killpg = setsid = wait4 = getrusage = None
+try:  # Python 2
+    from Queue import Queue, Empty
+except ImportError:  # Python 3
+    from queue import Queue, Empty
 
 def main():
     # I think this can also be run from Makefile.py directly (NOT TESTED!)
@@ -20,6 +44,12 @@ def main():
     # make.start_logging()
     # make.run_directly(todo)
 
+    # Stop as on Ctrl-C, so running commands are stopped too
+    def terminate(signum, frame):
+        sys.exit(128 + signum)
+
+    signal.signal(signal.SIGTERM, terminate)
+
     make = MakeInternals()
     make.parse_cli()
     make.start_logging()
@@ -33,34 +63,48 @@ class MakeInternals():
 
     def __init__(self):
         self.timestampts = OrderedDict()
+        self.lock        = Lock()
 
-    def timer(self, target, name):
-        nowdt  = datetime.now()
+    def timer(self, target, name, nowdt = None):
+        nowdt  = datetime.now() if nowdt is None else nowdt
         nowstr = nowdt.strftime("%H:%M %a %b %d, %Y")
-        if target not in self.timestampts.keys():
-            self.timestampts[target] = OrderedDict()
+        with self.lock:
+            if target not in self.timestampts.keys():
+                self.timestampts[target] = OrderedDict()
+
+            i = 1
+            names  = self.timestampts[target].keys()
+            nameok = name
+            while nameok in names:
+                nameok = name + " ({0})".format(i)
+                i += 1
 
-        i = 1
-        names  = self.timestampts[target].keys()
-        nameok = name
-        while nameok in names:
-            nameok = name + " ({0})".format(i)
-            i += 1
+            self.timestampts[target][nameok] = nowstr, nowdt
 
-        self.timestampts[target][nameok] = nowstr, nowdt
+    def record(self, **kwargs):
+        """Write a JSON record to the log (only with --json-log)"""
+        if hasattr(sys.stdout, 'record'):
+            sys.stdout.record(**kwargs)
 
     def set_options(self,
-                    tags         = [],
-                    run_all      = False,
-                    dryrun       = False,
-                    gen_bash     = False,
-                    init         = False,
-                    clean        = False,
-                    skip_checks  = False,
-                    checks_first = False,
-                    bash_file    = "make.sh",
-                    logfile      = None,
-                    nolog        = False):
+                    tags          = [],
+                    run_all       = False,
+                    dryrun        = False,
+                    gen_bash      = False,
+                    init          = False,
+                    clean         = False,
+                    skip_checks   = False,
+                    checks_first  = False,
+                    bash_file     = "make.sh",
+                    logfile       = None,
+                    nolog         = False,
+                    log_tail      = None,
+                    json_log      = False,
+                    jobs          = 1,
+                    target_jobs   = 1,
+                    rebuild       = False,
+                    profile       = False,
+                    stata_session = False):
         """Set options for make object
 
         Kwargs:
@@ -74,22 +118,40 @@ class MakeInternals():
             bash_file (str): Custom name for bash file to generate
             logfile (str): Custom name for log file
             nolog (bool): DO not create a log file
+            log_tail (int): Only append the last log_tail bytes of each
+                            program log to the log file
+            json_log (bool): Also write a JSON record per step to a
+                             .jsonl file next to the log file
+            jobs (int): Number of add_run steps to run at the same time
+            target_jobs (int): Number of targets to run at the same time
+            rebuild (bool): Run steps even if the build database says
+                            they are up to date
+            profile (bool): Report timings from previous builds, do not run
+            stata_session (bool): Run consecutive Stata steps in a single
+                                  Stata session
 
         Returns: Sets options internally for make
 
         """
-        self.args                 = {}
-        self.args['tags']         = tags
-        self.args['run_all']      = run_all
-        self.args['dryrun']       = dryrun
-        self.args['gen_bash']     = gen_bash
-        self.args['init']         = init
-        self.args['clean']        = clean
-        self.args['skip_checks']  = skip_checks
-        self.args['checks_first'] = checks_first
-        self.args['bash_file']    = bash_file
-        self.args['logfile']      = logfile
-        self.args['nolog']        = nolog
+        self.args                   = {}
+        self.args['tags']           = tags
+        self.args['run_all']        = run_all
+        self.args['dryrun']         = dryrun
+        self.args['gen_bash']       = gen_bash
+        self.args['init']           = init
+        self.args['clean']          = clean
+        self.args['skip_checks']    = skip_checks
+        self.args['checks_first']   = checks_first
+        self.args['bash_file']      = bash_file
+        self.args['logfile']        = logfile
+        self.args['nolog']          = nolog
+        self.args['log_tail']       = log_tail
+        self.args['json_log']       = json_log
+        self.args['jobs']           = jobs
+        self.args['target_jobs']    = target_jobs
+        self.args['rebuild']        = rebuild
+        self.args['profile']        = profile
+        self.args['stata_session']  = stata_session
 
     def parse_cli(self):
         """Parse CLI arguments
@@ -171,6 +233,57 @@ class MakeInternals():
                             action   = 'store_true',
                             help     = "Do not create a log file.",
                             required = False)
+        parser.add_argument('--log-tail',
+                            dest     = 'log_tail',
+                            type     = int,
+                            metavar  = 'BYTES',
+                            default  = None,
+                            help     = "Only append the last BYTES of each" +
+                                       " program log to the log file.",
+                            required = False)
+        parser.add_argument('--json-log',
+                            dest     = 'json_log',
+                            action   = 'store_true',
+                            help     = "Also log a JSON record per step.",
+                            required = False)
+        parser.add_argument('-j', '--jobs',
+                            dest     = 'jobs',
+                            type     = int,
+                            nargs    = '?',
+                            metavar  = 'JOBS',
+                            default  = 1,
+                            const    = cpu_count(),
+                            help     = "Run up to JOBS independent steps at" +
+                                       " once (all cores if JOBS is omitted)",
+                            required = False)
+        parser.add_argument('--target-jobs',
+                            dest     = 'target_jobs',
+                            type     = int,
+                            nargs    = '?',
+                            metavar  = 'JOBS',
+                            default  = 1,
+                            const    = cpu_count(),
+                            help     = "Run up to JOBS targets at once, each" +
+                                       " in its own process",
+                            required = False)
+        parser.add_argument('--rebuild',
+                            dest     = 'rebuild',
+                            action   = 'store_true',
+                            help     = "Run steps even if up to date.",
+                            required = False)
+        parser.add_argument('--profile',
+                            dest     = 'profile',
+                            action   = 'store_true',
+                            help     = "Report slowest steps, critical path" +
+                                       " and regressions from previous" +
+                                       " builds; do not run anything.",
+                            required = False)
+        parser.add_argument('--stata-session',
+                            dest     = 'stata_session',
+                            action   = 'store_true',
+                            help     = "Run consecutive Stata steps in a" +
+                                       " single Stata session.",
+                            required = False)
         parser.add_argument('-v', '--version',
                             action   = 'version',
                             version  = '0.1',
@@ -189,10 +302,18 @@ class MakeInternals():
         else:
             logfile = path.join(getcwd(), self.args['logfile'])
 
+        if self.args['json_log']:
+            jsonlog = path.splitext(logfile)[0] + '.jsonl'
+        else:
+            jsonlog = None
+
+        self.logfile = logfile
         if not self.args['nolog']:
-            sys.stdout     = Logger(logfile = logfile)
+            sys.stdout     = Logger(logfile = logfile, jsonlog = jsonlog)
             self.loghandle = sys.stdout.log
-            self.log       = AppendLogger(self.loghandle)
+            self.log       = AppendLogger(self.loghandle,
+                                          maxsize = self.args['log_tail'],
+                                          lock    = sys.stdout.lock)
 
     def check_targets(self):
         """Check each target exist and has a Makefile.py
@@ -218,15 +339,18 @@ class MakeInternals():
     def run_targets(self):
         """Run tags from targets passed to args
 
+        With --target-jobs, targets run at the same time, each in its
+        own process (see run_target_process).
+
         Returns: Run Makefile.py in each target
 
         """
 
-        msg_dryrun   = "THIS IS A DRY RUN! Nothing should execute."
-        msg_gen_bash = 'This only generates "{0}"! Nothing should execute.'
+        msg_dryrun = "THIS IS A DRY RUN! Nothing should execute."
 
-        msg_Makefile_ok   = "Running code as specified in '{0}'"
-        msg_Makefile_fail = "Makefile.py import for '{0}' failed"
+        if self.args['profile']:
+            self.profile_targets()
+            return(0)
 
         if self.args['dryrun']:
             print(msg_dryrun)
@@ -237,59 +361,184 @@ class MakeInternals():
         if self.ntargs > 1:
             self.timer('all-start', 'Start')
 
-        for target in self.targets:
-            # Clear objects to use
-            todo = None
-            self.Makefile_objects = {}
-
-            # Files names to use in loop
-            bash_file = path.join(target, self.args["bash_file"])
-            Makefile  = path.join(target, "Makefile.py")
-
-            # Init messages if dryrun, gen_bash requested
-            if self.args['gen_bash'] and not self.args['dryrun']:
-                print(msg_gen_bash.format(self.args['bash_file']))
-                with open(bash_file, "w+") as bf:
-                    bf.write("#!/bin/bash" + 2 * linesep)
-
-            # Import Makefile.py
-            # try:  # Python 2
-            #     execfile(Makefile, self.Makefile_objects)
-            # except:  # Python 3
-            #     exec(open(Makefile, "rb").read(), self.Makefile_objects)
-            try:
-                execfile(Makefile, self.Makefile_objects)
-            except Warning as warn:
-                msg  = "'{0}' raised a warning: {1}" + linesep
-                msg += "Execution will continue; "
-                msg += "if you meant to stop the execution, use 'exit()'."
-                print(msg.format(Makefile, warn))
-
-            # Check import of 'todo' object was successful
+        tjobs    = self.args['target_jobs']
+        parallel = tjobs > 1 and self.ntargs > 1
+        parallel = parallel and not self.args['dryrun']
+        parallel = parallel and not self.args['gen_bash']
+        if parallel:
+            scheduler = MakeScheduler(jobs = tjobs)
+            for target in self.targets:
+                scheduler.add(target, [], [], True, target)
+
             try:
-                todo = self.Makefile_objects['todo']
-            except:
-                raise Warning(msg_Makefile_fail.format(target))
-
-            # Symlinks to lib, data, out, tmp if requested
-            if self.args['init'] or self.args['clean']:
-                self.init_target(target, todo)
-                if self.args['tags'] == [] and self.args['clean']:
-                    msg  = "Specify tags explicitly to run after --clean;"
-                    msg += " skipping '{0}'".format(Makefile)
-                    print(msg)
+                scheduler.run(self.run_target_process)
+            finally:
+                # Report targets in the order they were requested
+                order = ['all-start'] + self.targets
+                for key in order:
+                    if key in self.timestampts.keys():
+                        self.timestampts[key] = self.timestampts.pop(key)
+        else:
+            for target in self.targets:
+                if not self.run_target(target):
                     return(0)
 
-            # Run Makefile.py in target
-            print(linesep + msg_Makefile_ok.format(Makefile))
-            todo.checktags = OrderedDict()
-            self.run_Makefile(target, Makefile, todo)
-
         if self.ntargs > 1:
             self.timer('all-finish', 'Finish')
 
         self.finish(tabs)
 
+    def run_target(self, target):
+        """Run tags from a single target
+
+        Args:
+            target (str): Path to target
+
+        Returns: Run Makefile.py in target; False if the run should stop
+
+        """
+
+        msg_gen_bash    = 'This only generates "{0}"! Nothing should execute.'
+        msg_Makefile_ok = "Running code as specified in '{0}'"
+
+        # Files names to use in loop
+        bash_file = path.join(target, self.args["bash_file"])
+        Makefile  = path.join(target, "Makefile.py")
+
+        # Init messages if dryrun, gen_bash requested
+        if self.args['gen_bash'] and not self.args['dryrun']:
+            print(msg_gen_bash.format(self.args['bash_file']))
+            with open(bash_file, "w+") as bf:
+                bf.write("#!/bin/bash" + 2 * linesep)
+
+        todo = self.load_todo(target)
+
+        # Symlinks to lib, data, out, tmp if requested
+        if self.args['init'] or self.args['clean']:
+            self.init_target(target, todo)
+            if self.args['tags'] == [] and self.args['clean']:
+                msg  = "Specify tags explicitly to run after --clean;"
+                msg += " skipping '{0}'".format(Makefile)
+                print(msg)
+                return False
+
+        # Run Makefile.py in target
+        print(linesep + msg_Makefile_ok.format(Makefile))
+        todo.checktags = OrderedDict()
+        self.run_Makefile(target, Makefile, todo)
+        return True
+
+    def load_todo(self, target):
+        """Import Makefile.py from target
+
+        Args:
+            target (str): Path to target
+
+        Returns: 'todo' object (MakefileTodo) defined in Makefile.py
+
+        """
+
+        msg_Makefile_fail = "Makefile.py import for '{0}' failed"
+
+        # Clear objects to use
+        todo = None
+        self.Makefile_objects = {}
+        Makefile = path.join(target, "Makefile.py")
+
+        # Import Makefile.py
+        # try:  # Python 2
+        #     execfile(Makefile, self.Makefile_objects)
+        # except:  # Python 3
+        #     exec(open(Makefile, "rb").read(), self.Makefile_objects)
+        try:
+            execfile(Makefile, self.Makefile_objects)
+        except Warning as warn:
+            msg  = "'{0}' raised a warning: {1}" + linesep
+            msg += "Execution will continue; "
+            msg += "if you meant to stop the execution, use 'exit()'."
+            print(msg.format(Makefile, warn))
+
+        # Check import of 'todo' object was successful
+        try:
+            todo = self.Makefile_objects['todo']
+        except:
+            raise Warning(msg_Makefile_fail.format(target))
+
+        return todo
+
+    def profile_targets(self):
+        """Print timing reports from each target's history file
+
+        Returns: Prints slowest steps, critical path and regressions
+
+        """
+        for target in self.targets:
+            todo = self.load_todo(target)
+            if todo.default.history is None:
+                print("No history kept for '{0}'".format(target))
+                continue
+
+            histfile = path.join(target, todo.default.history)
+            report   = MakeProfile(histfile).report()
+            print(linesep + "Profile for '{0}'".format(target))
+            print(linesep.join([("\t" + r).rstrip() for r in report]))
+
+    def run_target_process(self, target):
+        """Run a single target in a child process
+
+        The child writes everything to a log in the target folder (named
+        like make.py's log), which is then printed here in one piece so
+        the output of concurrent targets is not interleaved (with --nolog
+        the child prints as it goes instead). The child's timestamps are
+        merged into this object for finish().
+
+        Args:
+            target (str): Path to target
+
+        Returns: Run Makefile.py in target; raises Warning if it failed
+
+        """
+        logfile = path.join(target, path.basename(self.logfile))
+        if path.abspath(logfile) == path.abspath(self.logfile):
+            logfile += '.target'
+
+        nolog = self.args['nolog']
+        if nolog:
+            print("Started target '{0}'".format(target))
+        else:
+            print("Started target '{0}' (log: {1})".format(target, logfile))
+
+        sys.stdout.flush()
+        recv, send = Pipe(False)
+        child = Process(target = run_target_child,
+                        args   = (self.args, target, logfile, send))
+        child.start()
+        send.close()
+        try:
+            status, timestamps = recv.recv()
+        except EOFError:
+            status, timestamps = 1, OrderedDict()
+
+        child.join()
+        jsonlog = path.splitext(logfile)[0] + '.jsonl'
+        with self.lock:
+            self.timestampts[target] = timestamps
+            if not nolog and path.isfile(logfile):
+                with open(logfile, 'r') as tlog:
+                    sys.stdout.write(tlog.read())
+
+            jsonlog_ok = not nolog and self.args['json_log']
+            if jsonlog_ok and path.isfile(jsonlog):
+                with open(jsonlog, 'r') as tjson:
+                    for line in tjson:
+                        self.record(**json.loads(line))
+
+        if status != 0 and nolog:
+            raise Warning("Target '{0}' failed".format(target))
+        elif status != 0:
+            msg = "Target '{0}' failed; see '{1}'"
+            raise Warning(msg.format(target, logfile))
+
     def run_directly(self, todo):
         """Run given existing todo object
 
@@ -470,6 +719,12 @@ class MakeInternals():
         self.timer(target, "\tStarted run for '{0}'".format(target))
         self.load_defaults(todo, fullpath)
 
+        if dryrun or gen_bash or todo.default.history is None:
+            self.profile = None
+        else:
+            histfile     = path.join(fullpath, todo.default.history)
+            self.profile = MakeProfile(histfile)
+
         # Check if there is anything to do
         # --------------------------------
 
@@ -527,6 +782,9 @@ class MakeInternals():
 
         # Ensure steps are run in order (but bundle similar steps)
         for loop in todo.loop:
+            if self.profile is not None:
+                self.profile.block()
+
             if loop in ["sync"]:
                 self.loop_sync(todo, fullpath)
             elif loop in ["get"]:
@@ -807,15 +1065,18 @@ class MakeInternals():
             execbase = 'rsync {0} '.format(flags)
             if partial is None:
                 execlist = [execbase + ' "{0}" "{1}"'.format(src, dest)]
+                namelist = ['{0} -> {1}'.format(src, dest)]
             else:
                 execlist = []
+                namelist = []
                 for psrc in partial.keys():
                     pdest = path.join(dest, partial[psrc])
                     psrc  = path.join(src, psrc)
                     execlist += [execbase + ' "{0}" "{1}"'.format(psrc, pdest)]
+                    namelist += ['{0} -> {1}'.format(psrc, pdest)]
 
             # Loop through folders to sync
-            for execstr in execlist:
+            for execstr, name in zip(execlist, namelist):
                 wd = getcwd()
                 chdir(fullpath)
 
@@ -837,7 +1098,17 @@ class MakeInternals():
                 #     raise OSError(msg.format(path_src))
 
                 # Sync source to dest
-                system(execstr)
+                start  = time()
+                result = run_command(execstr)
+                self.add_profile('sync', name, start, [result])
+                self.record(target  = fullpath,
+                            kind    = 'sync',
+                            command = execstr.strip(),
+                            **result)
+                if result['status'] != 0:
+                    msg = "\tWARNING: Non-0 exit status ({0}) for `{1}`"
+                    print(msg.format(result['status'], execstr.strip()))
+
                 chdir(wd)
 
     def loop_get(self, todo, fullpath):
@@ -925,6 +1196,7 @@ class MakeInternals():
 
             # Create symlink; if already a symlink then replace; if a
             # file or folder then exit with error
+            start     = time()
             base_dest = path.dirname(path_dest)
             if base_dest != "":
                 makedirs_safe(base_dest)
@@ -934,14 +1206,33 @@ class MakeInternals():
             else:
                 symlink_replace(path_src, path_dest)
 
+            name = '{0} -> {1}'.format(path_src, path_dest)
+            self.add_profile('get', name, start)
             chdir(wd)
 
     def loop_run(self, todo, fullpath, target):
         """Executes all the scripts requested by add_run
 
+        Steps are handed to MakeScheduler, which runs up to --jobs of
+        them at a time. A step waits for every earlier step that writes
+        one of its inputs, reads one of its outputs, or writes one of
+        its outputs. Steps that declare no inputs or outputs wait for
+        (and block) everything declared before them, so Makefiles that
+        do not declare anything still run in order.
+
+        Steps that declare outputs are skipped if the build database
+        (todo.default.builddb, off unless set to a file name) shows
+        their commands, inputs and outputs are unchanged since they
+        last ran successfully.
+
+        With --stata-session, consecutive Stata steps are scheduled as
+        a single step that runs them in one Stata session (see
+        run_stata_session).
+
         Args:
             todo (MakefileTodo): Object containing what to do
             fullpath (str): Full file path of target folder
+            target (str): Folder path
 
         Returns: Executes scripts requested by add_run
 
@@ -949,20 +1240,33 @@ class MakeInternals():
         run_all   = self.args['run_all']
         dryrun    = self.args['dryrun']
         tags      = self.args['tags'] if self.args['tags'] != [] else ["all"]
-        checkit   = not self.args['checks_first']
-        checkit   = checkit and not self.args['skip_checks']
-        bash_file = self.args["bash_file"]
         gen_bash  = self.args['gen_bash']
-        nolog     = self.args['nolog']
+        jobs      = self.args['jobs']
 
+        if dryrun or gen_bash or todo.default.builddb is None:
+            self.builddb = None
+        else:
+            dbfile       = path.join(fullpath, todo.default.builddb)
+            self.builddb = MakeDatabase(dbfile, fullpath)
+
+        scheduler = MakeScheduler(jobs = 1 if dryrun or gen_bash else jobs)
+        session   = self.args['stata_session'] and not dryrun and not gen_bash
+        names     = []
+        keynames  = {}
+        steps     = []
         for key in todo.run:
-            run   = todo.run[key]
-            opts  = run['options']
-            args  = run['args']
-            rfile = run['file']
-            oext  = run['oext']
-            executable  = run['exec']
-            fname, fext = path.splitext(rfile)
+            run = todo.run[key]
+
+            # Name steps by file, as timer() does, so that they can be
+            # found in the build database regardless of requested tags
+            i = 1
+            name = run['file']
+            while name in names:
+                name = run['file'] + " ({0})".format(i)
+                i += 1
+
+            names += [name]
+            keynames[key] = name
 
             # Ignore if tag not in tags
             keep = run_all
@@ -973,79 +1277,97 @@ class MakeInternals():
             if not keep and not gen_bash:
                 continue
 
-            # Parse all the things to run
-            # ---------------------------
-
-            dext   = todo.extensions
-            drules = todo.rules
-            torun  = []
-
-            # TODO: path to rules.conf? // 2017-02-19 20:42 EST
-            if executable is None:
-                # If no exec, rules must be specified
-                if run['rules'] is None:
-                    # If no rules, try to guess
-                    if todo.default.guessrules:
-                        # Add rule for known extension
-                        if fext in dext.keys():
-                            # Extension may specify several rules
-                            for rule in dext[fext].keys():
-                                kwargs = dext[fext][rule]
-                                kwargs['args'] = args
-                                kwargs['opts'] = opts
-                                attr   = rule + 'Parse'
-                                if attr in dir(todo.parse):
-                                    parse  = getattr(todo.parse, attr)
-                                    torun += parse(rfile, **kwargs)
-                                else:
-                                    if opts is None:
-                                        dopts = todo.rules[rule]['options']
-                                    else:
-                                        dopts = opts
-
-                                    dexec  = todo.rules[rule]['executable']
-                                    dtuple = (dexec, dopts, rfile, args)
-                                    dstr   = '{0} {1} "{2}" {3}'
-                                    torun += [dstr.format(*dtuple)]
-                        else:
-                            msg  = "Nothing to do:"
-                            msg += " No executable,"
-                            msg += " no rules,"
-                            msg += " extension '{0}' not known."
-                            raise Warning(msg.format(fext))
-                    else:
-                        msg  = "Nothing to do:"
-                        msg += " No executable,"
-                        msg += " no rules,"
-                        msg += " guessrules set to False."
-                        raise Warning(msg)
-                else:
-                    # Check rules are known
-                    unknown = False
-                    norules = []
-                    for rule in flatten([run['rules']]):
-                        if rule not in drules.keys():
-                            unknown  = True
-                            norules += [rule]
-
-                    if unknown:
-                        msg  = "Requested rules '{0}'"
-                        msg += " for file '{1}' not known"
-                        raise Warning(msg.format(', '.join(norules), rfile))
-                    else:
-                        for rule in flatten([run['rules']]):
-                            attr = rule + 'Parse'
-                            if attr in dir(todo.parse):
-                                parse = getattr(todo.parse, attr)
-                                if run['rules_kwargs'] is not None:
-                                    kwargs = run['rules_kwargs']
-                                elif 'kwargs' in todo.rules[rule].keys():
-                                    kwargs = todo.rules[rule]['kwargs']
-                                else:
-                                    kwargs = {}
+            # Files read and written by the step; the script and any
+            # files checked for the step's tags count as inputs.
+            inputs = [run['file'], run['inputs']]
+            for rtag in run['tags']:
+                if rtag in todo.checktags.keys():
+                    inputs += todo.checktags[rtag]
+
+            inputs  = [path.join(fullpath, f) for f in filelist(inputs)]
+            outputs = filelist(run['outputs'])
+            outputs = [path.join(fullpath, f) for f in outputs]
+            declare = run['inputs'] is not None or run['outputs'] is not None
+            torun   = self.parse_run(todo, run)
+            stata   = session and self.stata_step(todo, run, torun)
+            step    = (key, run, torun, name, inputs, outputs, declare)
+            if stata and steps != [] and steps[-1][0]:
+                steps[-1][1].append(step)
+            else:
+                steps.append((stata, [step]))
+
+        # With --stata-session, consecutive Stata steps run as one step
+        groups = {}
+        for stata, group in steps:
+            key, run, torun, name, inputs, outputs, declare = group[0]
+            if len(group) > 1:
+                inputs  = [f for step in group for f in step[4]]
+                outputs = [f for step in group for f in step[5]]
+                declare = all([step[6] for step in group])
+
+            # Steps that declare no files wait for every step before
+            # them; the history only keeps the one right before
+            groups[key] = [step[3] for step in group]
+            deps = scheduler.depends(inputs, outputs, declare)
+            deps = [keynames[d] for d in (deps if declare else deps[-1:])]
+            if len(group) == 1:
+                scheduler.add(key, inputs, outputs, declare,
+                              self.run_step, todo, fullpath, target,
+                              run, torun, name, inputs, outputs, deps)
+            else:
+                scheduler.add(key, inputs, outputs, declare,
+                              self.run_stata_session, todo, fullpath,
+                              target, key, [s[1:6] for s in group], deps)
+
+        # Start steps on the longest path first, based on past builds
+        if self.profile is not None and jobs > 1:
+            durations = self.profile.durations()
+            weights   = {}
+            for key, gnames in groups.items():
+                known = [durations[n] for n in gnames if n in durations]
+                if known != []:
+                    weights[key] = sum(known)
+
+            scheduler.prioritize(weights)
+
+        scheduler.run(lambda func, *args: func(*args))
 
-                                kwargs['args'] = args
-                                kwargs['opts'] = opts
+    def parse_run(self, todo, run):
+        """Parse the commands to execute for an add_run entry
+
+        Args:
+            todo (MakefileTodo): Object containing what to do
+            run (dict): Entry of todo.run
+
+        Returns: List of commands to execute, in order
+
+        """
+        opts  = run['options']
+        args  = run['args']
+        rfile = run['file']
+        executable  = run['exec']
+        fname, fext = path.splitext(rfile)
+
+        dext   = todo.extensions
+        drules = todo.rules
+        torun  = []
+
+        # TODO: path to rules.conf? // 2017-02-19 20:42 EST
+        if executable is None:
+            # If no exec, rules must be specified
+            if run['rules'] is None:
+                # If no rules, try to guess
+                if todo.default.guessrules:
+                    # Add rule for known extension
+                    if fext in dext.keys():
+                        # Extension may specify several rules
+                        for rule in dext[fext].keys():
+                            kwargs = dext[fext][rule]
+                            kwargs['args'] = args
+                            kwargs['opts'] = opts
+                            attr   = rule + 'Parse'
+                            if attr in dir(todo.parse):
+                                parse  = getattr(todo.parse, attr)
                                 torun += parse(rfile, **kwargs)
                             else:
                                 if opts is None:
@@ -1057,66 +1379,484 @@ class MakeInternals():
                                 dtuple = (dexec, dopts, rfile, args)
                                 dstr   = '{0} {1} "{2}" {3}'
                                 torun += [dstr.format(*dtuple)]
+                    else:
+                        msg  = "Nothing to do:"
+                        msg += " No executable,"
+                        msg += " no rules,"
+                        msg += " extension '{0}' not known."
+                        raise Warning(msg.format(fext))
+                else:
+                    msg  = "Nothing to do:"
+                    msg += " No executable,"
+                    msg += " no rules,"
+                    msg += " guessrules set to False."
+                    raise Warning(msg)
             else:
-                # If executable was specified, parse user-provided options
-                opts = "" if opts is None else opts
-                for prog in flatten([executable]):
-                    dstr   = '{0} {1} "{2}" {3}'
-                    torun += [dstr.format(prog, opts, rfile, args)]
-
-            # Run the things!
-            # ---------------
-
-            self.timer(target, "\t\tRunning '{0}'".format(rfile))
-            for execstr in torun:
-                print("\t" + execstr)
-                if dryrun:
-                    continue
+                # Check rules are known
+                unknown = False
+                norules = []
+                for rule in flatten([run['rules']]):
+                    if rule not in drules.keys():
+                        unknown  = True
+                        norules += [rule]
+
+                if unknown:
+                    msg  = "Requested rules '{0}'"
+                    msg += " for file '{1}' not known"
+                    raise Warning(msg.format(', '.join(norules), rfile))
+                else:
+                    for rule in flatten([run['rules']]):
+                        attr = rule + 'Parse'
+                        if attr in dir(todo.parse):
+                            parse = getattr(todo.parse, attr)
+                            if run['rules_kwargs'] is not None:
+                                kwargs = run['rules_kwargs']
+                            elif 'kwargs' in todo.rules[rule].keys():
+                                kwargs = todo.rules[rule]['kwargs']
+                            else:
+                                kwargs = {}
 
-                wd = getcwd()
-                chdir(fullpath)
+                            kwargs['args'] = args
+                            kwargs['opts'] = opts
+                            torun += parse(rfile, **kwargs)
+                        else:
+                            if opts is None:
+                                dopts = todo.rules[rule]['options']
+                            else:
+                                dopts = opts
 
-                if gen_bash:
-                    with open(bash_file, "a+") as bf:
-                        bf.write(execstr)
-                        bf.write(linesep)
+                            dexec  = todo.rules[rule]['executable']
+                            dtuple = (dexec, dopts, rfile, args)
+                            dstr   = '{0} {1} "{2}" {3}'
+                            torun += [dstr.format(*dtuple)]
+        else:
+            # If executable was specified, parse user-provided options
+            opts = "" if opts is None else opts
+            for prog in flatten([executable]):
+                dstr   = '{0} {1} "{2}" {3}'
+                torun += [dstr.format(prog, opts, rfile, args)]
 
-                    chdir(wd)
+        return torun
+
+    def run_step(self, todo, fullpath, target, run, torun,
+                 name = None, inputs = [], outputs = [], deps = []):
+        """Execute the commands parsed for one add_run entry
+
+        This may be called from a MakeScheduler worker thread, so it
+        must not change the working directory; commands run with
+        'fullpath' as their working directory instead.
+
+        Args:
+            todo (MakefileTodo): Object containing what to do
+            fullpath (str): Full file path of target folder
+            target (str): Folder path
+            run (dict): Entry of todo.run
+            torun (list): Commands to execute, from parse_run
+
+        Kwargs:
+            name (str): Name of the step in the build database
+            inputs (list): Full paths of files the step reads
+            outputs (list): Full paths of files the step writes
+            deps (list): Names of the steps this step waited for
+
+        Returns: Executes the commands; raises Warning on non-0 exit
+
+        """
+        dryrun    = self.args['dryrun']
+        checkit   = not self.args['checks_first']
+        checkit   = checkit and not self.args['skip_checks']
+        bash_file = path.join(fullpath, self.args["bash_file"])
+        gen_bash  = self.args['gen_bash']
+        nolog     = self.args['nolog']
+        rfile     = run['file']
+        builddb   = self.builddb if run['outputs'] is not None else None
+        prefix    = "[{0}] ".format(rfile) if self.args['jobs'] > 1 else ''
+
+        # Skip if nothing changed since the last successful run
+        if builddb is not None:
+            state = builddb.state(inputs)
+            if not self.args['rebuild']:
+                if builddb.uptodate(name, torun, state, outputs):
+                    print("\t'{0}' is up to date.".format(rfile))
+                    self.record(target = target,
+                                kind   = 'run',
+                                file   = rfile,
+                                status = 'up to date')
+                    return
+
+            builddb.forget(name)
+
+        self.timer(target, "\t\tRunning '{0}'".format(rfile))
+        start   = time()
+        results = []
+        for execstr in torun:
+            print("\t" + execstr)
+            if dryrun:
+                continue
+
+            if gen_bash:
+                with open(bash_file, "a+") as bf:
+                    bf.write(execstr)
+                    bf.write(linesep)
+
+                continue
+
+            # Check relevant files now if not checked first
+            if checkit:
+                self.check_tags(todo, fullpath, run)
+
+            # Run and try to get exit status from program, or call
+            # the function for commands that make.py runs itself (see
+            # MakeCall). Note Makefile.py may use another copy of this
+            # module, so this does not check the class.
+            if hasattr(execstr, 'call'):
+                result = execstr.call(cwd     = fullpath,
+                                      timeout = run['timeout'],
+                                      prefix  = prefix)
+            else:
+                result = run_command(execstr,
+                                     cwd     = fullpath,
+                                     timeout = run['timeout'],
+                                     prefix  = prefix)
+            status = result['status']
+            results += [result]
+
+            msg = "\t\tExit status {0} for '{1}' after {2:.1f}s"
+            msg += " (CPU {3:.1f}s, peak memory {4:.0f} MB)"
+            print(msg.format(status, rfile, result['wall'], result['cpu'],
+                             result['maxrss'] / 1024.0))
+            self.record(target  = target,
+                        kind    = 'run',
+                        file    = rfile,
+                        command = execstr,
+                        **result)
+
+            # Try to cat the file log
+            if not nolog:
+                self.attach_logs(fullpath, run, execstr)
+
+            if result['timeout'] or status != 0:
+                self.add_profile('run', name, start, results, deps)
+
+            if result['timeout']:
+                msg = "Timed out after {0} seconds: `{1}`"
+                raise Warning(msg.format(run['timeout'], execstr))
+            elif status != 0:
+                msg = "Non-0 exit status for `{0}`"
+                raise Warning(msg.format(execstr))
+
+        if not dryrun and not gen_bash:
+            self.add_profile('run', name, start, results, deps)
+
+        if builddb is not None:
+            builddb.record(name, torun, state, builddb.state(outputs))
+
+        sys.stdout.flush()
+
+    def check_tags(self, todo, fullpath, run):
+        """Check the files required by the tags of an add_run entry
+
+        Args:
+            todo (MakefileTodo): Object containing what to do
+            fullpath (str): Full file path of target folder
+            run (dict): Entry of todo.run
+
+        Returns: Raises OSError if a file is missing
+
+        """
+        for rtag in run['tags']:
+            if rtag in todo.checktags.keys():
+                mtag = "\t\tRelevant tag: {0}".format(rtag)
+                for cfile in todo.checktags[rtag]:
+                    mfile = "\t\tCannot find '{0}'".format(cfile)
+                    msg   = mfile + linesep + mtag
+                    cpath = path.join(fullpath, cfile)
+                    ok    = path.isdir(cpath) or path.isfile(cpath)
+                    if not ok:
+                        raise OSError(msg)
+                    else:
+                        print("\t\tFound '{0}'".format(cfile))
+
+    def attach_logs(self, fullpath, run, execstr):
+        """Append the logs of an add_run entry to the log file
+
+        Logs are the script's name with each of the entry's output
+        extensions (e.g. 'analysis.log' for 'analysis.do'); they are
+        deleted once appended.
+
+        Args:
+            fullpath (str): Full file path of target folder
+            run (dict): Entry of todo.run
+            execstr (str): Command that wrote the logs
+
+        """
+        fname = path.splitext(run['file'])[0]
+        for ext in run['oext']:
+            assumed_log = path.join(fullpath, fname + ext)
+            if path.isfile(assumed_log):
+                self.log.append(fname + ext, execstr, fullpath)
+                unlink(assumed_log)
+            else:
+                msg = "\tWARNING: Could not attach '{0}'"
+                print(msg.format(fname + ext))
+
+    def stata_step(self, todo, run, torun):
+        """Whether an add_run entry can run in a Stata session
+
+        Only entries that run their do-file with the stata rule's own
+        command (i.e. stataParse with no custom options or prefix) are
+        run in a session; anything else runs by itself.
+
+        Args:
+            todo (MakefileTodo): Object containing what to do
+            run (dict): Entry of todo.run
+            torun (list): Commands to execute, from parse_run
+
+        Returns: bool
+
+        """
+        if path.splitext(run['file'])[1].lower() != '.do':
+            return False
+
+        return torun == todo.parse.stataParse(run['file'], args = run['args'])
+
+    def run_stata_session(self, todo, fullpath, target, key, steps,
+                          deps = []):
+        """Execute consecutive Stata steps in a single Stata session
+
+        Starting Stata takes a few seconds (more if a license has to
+        be checked out), which adds up over many short do-files. With
+        --stata-session, consecutive Stata steps are written to a
+        master do-file that runs each one with 'capture noisily do',
+        after 'clear all' and 'macro drop _all' so each starts out as
+        it would in its own session (settings changed with 'set' do
+        carry over, however). Markers around each do-file record where
+        and when (to the second) it starts and ends and its return code,
+        so the master log can be split into the log each do-file would
+        have written, each step gets its own entry in the timing history
+        and a failure is reported for the step that failed. The session
+        stops at the first error; Stata's own exit status is not relied
+        on, since it is 0 in batch mode even after an error.
+
+        Steps the build database shows are up to date are left out of
+        the session, unless an earlier step in it may change their
+        inputs. The session times out after the sum of the steps'
+        timeouts, if they all have one.
+
+        Args:
+            todo (MakefileTodo): Object containing what to do
+            fullpath (str): Full file path of target folder
+            target (str): Folder path
+            key (int): Key in todo.run of the first step
+            steps (list): (run, torun, name, inputs, outputs) for each
+                          step, in order; see run_step
+
+        Kwargs:
+            deps (list): Names of the steps the session waited for
+
+        Returns: Executes the steps; raises Warning on the first error
+
+        """
+        checkit = not self.args['checks_first']
+        checkit = checkit and not self.args['skip_checks']
+        nolog   = self.args['nolog']
+        master  = 'make_stata_session_{0}.do'.format(key)
+        prefix  = "[{0}] ".format(master) if self.args['jobs'] > 1 else ''
+        marker  = '@@make.py'
+        now     = 'c(current_date) " " c(current_time)'
+
+        # Skip steps that are up to date, as run_step does; written is
+        # None once a step might write anything
+        session = []
+        written = []
+        for run, torun, sname, inputs, outputs in steps:
+            builddb = self.builddb if run['outputs'] is not None else None
+            normed  = [path.normpath(f) for f in inputs]
+            if builddb is not None:
+                state = builddb.state(inputs)
+                fresh = written is not None
+                fresh = fresh and not overlap(written, normed)
+                fresh = fresh and not self.args['rebuild']
+                if fresh and builddb.uptodate(sname, torun, state, outputs):
+                    print("\t'{0}' is up to date.".format(run['file']))
+                    self.record(target = target,
+                                kind   = 'run',
+                                file   = run['file'],
+                                status = 'up to date')
                     continue
 
-                # Check relevant files now if not checked first
-                if checkit:
-                    for rtag in run['tags']:
-                        if rtag in todo.checktags.keys():
-                            mtag = "\t\tRelevant tag: {0}".format(rtag)
-                            for cfile in todo.checktags[rtag]:
-                                mfile = "\t\tCannot find '{0}'".format(cfile)
-                                msg   = mfile + linesep + mtag
-                                ok    = path.isdir(cfile) or path.isfile(cfile)
-                                if not ok:
-                                    raise OSError(msg)
-                                else:
-                                    print("\t\tFound '{0}'".format(cfile))
-
-                # Run and try to get exit status from program
-                status = system(execstr)
-
-                # Try to cat the file log
-                if not nolog:
-                    for ext in oext:
-                        assumed_log = fname + ext
-                        if path.isfile(assumed_log):
-                            self.log.append(assumed_log, execstr)
-                            unlink(assumed_log)
+                builddb.forget(sname)
+
+            if run['outputs'] is None or written is None:
+                written = None
+            else:
+                written += [path.normpath(f) for f in outputs]
+
+            session += [(run, torun, sname, inputs, outputs)]
+
+        if session == []:
+            return
+
+        # Write the master do-file
+        lines = []
+        for i, (run, torun, sname, inputs, outputs) in enumerate(session):
+            if checkit:
+                self.check_tags(todo, fullpath, run)
+
+            print("\t\tAdding '{0}' to '{1}'".format(run['file'], master))
+            print("\t" + torun[0])
+            lines += ['clear all',
+                      'macro drop _all',
+                      'quietly cd "{0}"'.format(fullpath),
+                      'display "{0}:begin:{1}:" {2}'.format(marker, i, now),
+                      'capture noisily do "{0}" {1}'.format(run['file'],
+                                                           run['args']),
+                      "local make_rc = _rc",
+                      "display \"{0}:end:{1}:`make_rc':\" {2}".format(marker,
+                                                                     i, now),
+                      "if `make_rc' != 0 exit `make_rc'"]
+
+        mfile = path.join(fullpath, master)
+        mlog  = path.splitext(mfile)[0] + '.log'
+        with open(mfile, 'w') as mhandle:
+            mhandle.write(linesep.join(lines) + linesep)
+
+        timeouts = [step[0]['timeout'] for step in session]
+        timeout  = None if None in timeouts else sum(timeouts)
+        execstr  = todo.parse.stataParse(master)[0]
+        self.timer(target, "\t\tRunning '{0}'".format(master))
+        print("\t" + execstr)
+        start = time()
+        try:
+            result = run_command(execstr,
+                                 cwd     = fullpath,
+                                 timeout = timeout,
+                                 prefix  = prefix)
+
+            # Split the master log at the markers; each is followed by
+            # the return code (end only) and the time
+            chunks  = {}
+            codes   = {}
+            begins  = {}
+            ends    = {}
+            current = None
+            re_mark = re.compile(re.escape(marker) +
+                                 r':(begin|end):(\d+):(?:(\d+):)?(.*)')
+            if path.isfile(mlog):
+                with open(mlog) as lhandle:
+                    for line in lhandle:
+                        match = re_mark.match(line)
+                        if match is None:
+                            if current is not None:
+                                chunks[current] += [line]
+                        elif match.group(1) == 'begin':
+                            current = int(match.group(2))
+                            chunks[current] = []
+                            begins[current] = stata_time(match.group(4))
                         else:
-                            msg = "\tWARNING: Could not attach '{0}'"
-                            print(msg.format(assumed_log))
+                            codes[current] = int(match.group(3))
+                            ends[current]  = stata_time(match.group(4))
+                            current = None
+        finally:
+            for sfile in [mfile, mlog]:
+                if path.isfile(sfile):
+                    unlink(sfile)
+
+        msg = "\t\tExit status {0} for '{1}' after {2:.1f}s"
+        msg += " (CPU {3:.1f}s, peak memory {4:.0f} MB)"
+        print(msg.format(result['status'], master, result['wall'],
+                         result['cpu'], result['maxrss'] / 1024.0))
+
+        # Each step waits for the one before it; steps without markers
+        # (e.g. after a timeout) end with the session
+        send  = start
+        sdeps = deps
+        for i, (run, torun, sname, inputs, outputs) in enumerate(session):
+            rfile  = run['file']
+            status = codes.get(i, result['status'] or 1)
+            sstart = begins.get(i) or send
+            send   = max(ends.get(i) or start + result['wall'], sstart)
+            self.timer(target, "\t\tRunning '{0}'".format(rfile),
+                       datetime.fromtimestamp(sstart))
+
+            msg = "\t\tExit status {0} for '{1}' after {2:.0f}s"
+            print(msg.format(status, rfile, send - sstart))
+            self.record(target  = target,
+                        kind    = 'run',
+                        file    = rfile,
+                        command = torun[0],
+                        session = execstr,
+                        status  = status)
+
+            # Each step's log is what it would have written by itself;
+            # drop the echo of the lines after its do-file
+            if i in chunks:
+                chunk = chunks[i]
+                while chunk != [] and 'make_rc' in chunk[-1]:
+                    chunk.pop()
+
+                fname = path.splitext(rfile)[0]
+                with open(path.join(fullpath, fname + '.log'), 'w') as log:
+                    log.write(''.join(chunk))
+
+            if not nolog:
+                self.attach_logs(fullpath, run, torun[0])
+
+            self.add_profile('run', sname, sstart, [], sdeps,
+                             end     = send,
+                             status  = status,
+                             session = master)
+            sdeps = [sname]
+            if status != 0:
+                if result['timeout'] and i not in codes:
+                    msg = "Timed out after {0} seconds: `{1}`"
+                    raise Warning(msg.format(timeout, execstr))
+                else:
+                    msg = "Non-0 exit status for `{0}` in `{1}`"
+                    raise Warning(msg.format(torun[0], execstr))
 
-                if status != 0:
-                    msg = "Non-0 exit status for `{0}`"
-                    raise Warning(msg.format(execstr))
+            builddb = self.builddb if run['outputs'] is not None else None
+            if builddb is not None:
+                builddb.record(sname, torun,
+                               builddb.state(inputs),
+                               builddb.state(outputs))
 
-                chdir(wd)
+        sys.stdout.flush()
+
+    def add_profile(self, kind, name, start,
+                    results = [],
+                    deps    = [],
+                    end     = None,
+                    **kwargs):
+        """Add a step to the timing history (see MakeProfile)
+
+        Args:
+            kind (str): One of run, sync, get
+            name (str): Name of the step
+            start (float): Start time (seconds since the epoch)
+
+        Kwargs:
+            results (list): Results from run_command for each command
+            deps (list): Names of the steps this step waited for
+            end (float): End time (default: now)
+            **kwargs: Other fields (e.g. status, if there are no results)
+
+        Returns: Adds step to self.profile, if keeping timings
+
+        """
+        if self.profile is None:
+            return
+
+        record = {}
+        if results != []:
+            record['status'] = [r['status'] for r in results if r['status']]
+            record['status'] = (record['status'] + [0])[0]
+            record['cpu']    = sum([r['cpu'] for r in results])
+            record['maxrss'] = max([r['maxrss'] for r in results])
+
+        record.update(kwargs)
+        end = time() if end is None else end
+        self.profile.add(kind, name, start, end, deps, **record)
 
     def loop_mail(self, todo, fullpath, target, Makefile):
         """Send e-mails if required
@@ -1202,7 +1942,7 @@ class MakeInternals():
 
                 # If AUTO, send simple message
                 if key == 'AUTO':
-                    system(emsg)
+                    run_command(emsg)
 
     def finish(self, tabs):
         """Print ending messages
@@ -1226,6 +1966,489 @@ class MakeInternals():
 # Aux classes
 
 
+class MakeScheduler():
+
+    """Run add_run steps concurrently, respecting their dependencies"""
+
+    def __init__(self, jobs = 1):
+        """Initialize an empty dependency graph
+
+        Kwargs:
+            jobs (int): Maximum number of steps to run at the same time
+
+        """
+        self.jobs    = max(1, jobs)
+        self.steps   = OrderedDict()
+        self.deps    = OrderedDict()
+        self.inputs  = {}
+        self.outputs = {}
+        self.declare = {}
+        self.weights = {}
+
+    def add(self, key, inputs, outputs, declare, *args):
+        """Add a step to the graph
+
+        The step depends on every earlier step that writes one of its
+        inputs, reads or writes one of its outputs, or declares nothing.
+        If this step declares nothing, it depends on all earlier steps.
+
+        Args:
+            key: Unique name for the step
+            inputs (list): Full paths of files the step reads
+            outputs (list): Full paths of files the step writes
+            declare (bool): Whether inputs/outputs were declared
+            *args: Arguments to pass to the function given to run()
+
+        Returns: Adds 'key' to the graph
+
+        """
+        inputs  = [path.normpath(f) for f in inputs]
+        outputs = [path.normpath(f) for f in outputs]
+
+        self.deps[key]    = self.depends(inputs, outputs, declare)
+        self.steps[key]   = args
+        self.inputs[key]  = inputs
+        self.outputs[key] = outputs
+        self.declare[key] = declare
+
+    def depends(self, inputs, outputs, declare):
+        """Steps added so far that a new step would depend on (see add)
+
+        Args:
+            inputs (list): Full paths of files the step reads
+            outputs (list): Full paths of files the step writes
+            declare (bool): Whether inputs/outputs were declared
+
+        Returns: List of keys
+
+        """
+        inputs  = [path.normpath(f) for f in inputs]
+        outputs = [path.normpath(f) for f in outputs]
+
+        deps = []
+        for prev in self.steps.keys():
+            if not declare or not self.declare[prev]:
+                deps += [prev]
+            elif overlap(self.outputs[prev], inputs + outputs):
+                deps += [prev]
+            elif overlap(self.inputs[prev], outputs):
+                deps += [prev]
+
+        return deps
+
+    def prioritize(self, weights):
+        """Set expected durations used to choose among ready steps
+
+        Args:
+            weights (dict): Expected seconds for each step key. Steps
+                            missing from weights are assumed to take the
+                            median of the known durations.
+
+        Returns: Sets self.weights
+
+        """
+        known = sorted([weights[key] for key in self.steps if key in weights])
+        guess = known[len(known) // 2] if known != [] else 0
+        for key in self.steps.keys():
+            self.weights[key] = weights.get(key, guess)
+
+    def ranks(self):
+        """Expected duration of the longest path starting at each step"""
+        children = dict((key, []) for key in self.steps.keys())
+        for key in self.steps.keys():
+            for dep in self.deps[key]:
+                children[dep] += [key]
+
+        ranks = {}
+        for key in reversed(list(self.steps.keys())):
+            after = [ranks[child] for child in children[key]]
+            ranks[key] = self.weights.get(key, 0) + max(after + [0])
+
+        return ranks
+
+    def run(self, func):
+        """Run func(*args) for each step once its dependencies are done
+
+        Ready steps with the longest expected path to the end of the
+        build (see prioritize) are started first; ties, including the
+        case where no durations are known, go in the order the steps
+        were added. After a step fails no new steps are started; the
+        steps already running are allowed to finish and the first error
+        is then re-raised. If interrupted (e.g. Ctrl-C), no new steps
+        are started, the commands of running steps are stopped (see
+        stop_commands), and the interruption is re-raised once they
+        have finished.
+
+        Args:
+            func (function): Function to run each step
+
+        Returns: Runs all the steps; raises the first error found
+
+        """
+        if self.jobs == 1:
+            for key in self.steps.keys():
+                func(*self.steps[key])
+
+            return
+
+        ranks    = self.ranks()
+        pending  = list(self.steps.keys())
+        pending  = sorted(pending, key = lambda key: -ranks[key])
+        running  = {}
+        done     = []
+        failed   = None
+        finished = Queue()
+
+        def worker(key):
+            try:
+                func(*self.steps[key])
+                finished.put((key, None))
+            except Exception as error:
+                finished.put((key, error))
+
+        try:
+            while pending or running:
+                if failed is None:
+                    for key in list(pending):
+                        if len(running) >= self.jobs:
+                            break
+
+                        if all([dep in done for dep in self.deps[key]]):
+                            pending.remove(key)
+                            thread = Thread(target = worker, args = (key,))
+                            thread.daemon = True
+                            thread.start()
+                            running[key] = thread
+
+                if not running:
+                    break
+
+                # Wait with a timeout, which python 2 can interrupt
+                try:
+                    key, error = finished.get(True, 1)
+                except Empty:
+                    continue
+
+                running.pop(key).join()
+                if error is None:
+                    done += [key]
+                elif failed is None:
+                    failed = error
+        except:
+            stop_commands()
+            for thread in running.values():
+                while thread.is_alive():
+                    thread.join(0.1)
+
+            raise
+
+        if failed is not None:
+            raise failed
+
+
+class MakeDatabase():
+
+    """Content hashes of add_run steps as of their last successful run"""
+
+    def __init__(self, dbfile, root):
+        """Load the database, if any
+
+        Args:
+            dbfile (str): JSON file with the database
+            root (str): Full path of target folder; files are stored
+                        relative to it
+
+        """
+        self.dbfile = dbfile
+        self.root   = root
+        self.lock   = RLock()
+        try:
+            with open(dbfile, 'r') as db:
+                saved = json.load(db)
+
+            self.files = saved['files']
+            self.steps = saved['steps']
+        except (IOError, OSError, ValueError, KeyError):
+            self.files = {}
+            self.steps = {}
+
+    def hash(self, fname):
+        """Content hash of a file or folder; None if it does not exist
+
+        The hash of a file is only computed if its modification time
+        or size differ from what is in the database.
+
+        Args:
+            fname (str): Full path to file or folder
+
+        Returns: Hash as a hex string
+
+        """
+        if path.isdir(fname):
+            sha = hashlib.sha1()
+            for root, dirs, files in walk(fname):
+                dirs.sort()
+                for f in sorted(files):
+                    full = path.join(root, f)
+                    sha.update(path.relpath(full, fname).encode('utf-8'))
+                    sha.update(str(self.hash(full)).encode('utf-8'))
+
+            return sha.hexdigest()
+        elif not path.isfile(fname):
+            return None
+
+        info = stat(fname)
+        rel  = path.relpath(fname, self.root)
+        with self.lock:
+            cached = self.files.get(rel)
+
+        if cached is not None:
+            if cached[0] == info.st_mtime and cached[1] == info.st_size:
+                return cached[2]
+
+        sha = hashlib.sha1()
+        with open(fname, 'rb') as f:
+            chunk = f.read(1048576)
+            while chunk:
+                sha.update(chunk)
+                chunk = f.read(1048576)
+
+        with self.lock:
+            self.files[rel] = [info.st_mtime, info.st_size, sha.hexdigest()]
+
+        return sha.hexdigest()
+
+    def state(self, fnames):
+        """Hashes of a list of files, keyed by their relative paths"""
+        state = {}
+        for fname in fnames:
+            state[path.relpath(fname, self.root)] = self.hash(fname)
+
+        return state
+
+    def uptodate(self, name, torun, inputs, outputs):
+        """Whether a step can be skipped
+
+        Args:
+            name (str): Name of the step
+            torun (list): Commands the step would run
+            inputs (dict): Current state of the step's inputs
+            outputs (list): Full paths of files the step writes
+
+        Returns: True if commands and inputs are the same as in the
+            last successful run and the outputs have not changed since
+
+        """
+        with self.lock:
+            step = self.steps.get(name)
+
+        if step is None:
+            return False
+        elif step['command'] != torun or step['inputs'] != inputs:
+            return False
+
+        current = self.state(outputs)
+        missing = None in current.values()
+        return not missing and step['outputs'] == current
+
+    def record(self, name, torun, inputs, outputs):
+        """Save the state of a step that ran successfully"""
+        with self.lock:
+            self.steps[name] = {
+                'command': torun,
+                'inputs': inputs,
+                'outputs': outputs
+            }
+
+        self.save()
+
+    def forget(self, name):
+        """Remove a step (e.g. before running it, in case it fails)"""
+        with self.lock:
+            if name in self.steps:
+                del self.steps[name]
+                self.save()
+
+    def save(self):
+        """Write the database atomically (dump to temp file, rename)"""
+        with self.lock:
+            tmpfile = self.dbfile + '.tmp'
+            with open(tmpfile, 'w') as db:
+                json.dump({'files': self.files, 'steps': self.steps}, db)
+
+            rename(tmpfile, self.dbfile)
+
+
+class MakeProfile():
+
+    """Timings of add_run, add_sync and add_get steps across builds"""
+
+    def __init__(self, histfile):
+        """Start a new build in the history file
+
+        Args:
+            histfile (str): JSON lines file with one record per step
+
+        """
+        self.histfile = histfile
+        self.build    = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        self.lock     = Lock()
+        self.previous = []
+        self.current  = []
+
+    def block(self):
+        """Start a new loop block; its steps wait for the previous one
+        (recorded as the step in it that finished last)"""
+        with self.lock:
+            if self.current != []:
+                self.previous = self.current
+                self.current  = []
+
+    def add(self, kind, name, start, end, deps = [], **kwargs):
+        """Append a step to the history file
+
+        Args:
+            kind (str): One of run, sync, get
+            name (str): Name of the step
+            start (float): Start time (seconds since the epoch)
+            end (float): End time (seconds since the epoch)
+
+        Kwargs:
+            deps (list): Names of steps in this block the step waited on
+            **kwargs: Other fields (e.g. status, cpu, maxrss)
+
+        Returns: Appends a JSON record to histfile
+
+        """
+        with self.lock:
+            record = {
+                'build': self.build,
+                'kind': kind,
+                'name': name,
+                'start': start,
+                'end': end,
+                'wall': end - start,
+                'deps': uniquelist([self.previous, deps])
+            }
+            record.update(kwargs)
+            self.current = [name]
+            with open(self.histfile, 'a') as hist:
+                hist.write(json.dumps(record, sort_keys = True) + '\n')
+
+    def durations(self, kind = 'run'):
+        """Median wall time of each step over successful runs"""
+        walls = {}
+        for steps in self.load().values():
+            for name, r in steps.items():
+                if r['kind'] == kind and r.get('status', 0) == 0:
+                    walls[name] = walls.get(name, []) + [r['wall']]
+
+        medians = {}
+        for name, w in walls.items():
+            medians[name] = sorted(w)[len(w) // 2]
+
+        return medians
+
+    def load(self):
+        """Read the history file into an OrderedDict of builds"""
+        builds = OrderedDict()
+        if path.isfile(self.histfile):
+            with open(self.histfile, 'r') as hist:
+                for line in hist:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+
+                    if record['build'] not in builds:
+                        builds[record['build']] = OrderedDict()
+
+                    builds[record['build']][record['name']] = record
+
+        return builds
+
+    def report(self, top = 10, threshold = 1.25):
+        """Report on the latest build in the history file
+
+        Args:
+            top (int): Number of slowest steps to show
+            threshold (float): Ratio to the median of previous builds
+                               above which a step counts as a regression
+
+        Returns: List of lines with the slowest steps, the critical
+            path, and steps slower than in previous builds
+
+        """
+        builds = self.load()
+        if len(builds) == 0:
+            return ["No history in '{0}'".format(self.histfile)]
+
+        latest = list(builds.keys())[-1]
+        steps  = builds[latest]
+        report = ["Build {0} ({1} steps; {2} builds in history)"]
+        report = [report[0].format(latest, len(steps), len(builds))]
+
+        # Slowest steps
+        report += ["", "Slowest steps:"]
+        slowest = sorted(steps.values(), key = lambda r: -r['wall'])
+        for r in slowest[:top]:
+            usage = []
+            if r.get('cpu') is not None:
+                usage += ["CPU {0:.1f}s".format(r['cpu'])]
+
+            if r.get('maxrss') is not None:
+                usage += ["{0:.0f} MB".format(r['maxrss'] / 1024.0)]
+
+            msg = "\t{0:>9.1f}s  {1:<5} {2}"
+            msg = msg.format(r['wall'], r['kind'], r['name'])
+            if usage != []:
+                msg += " ({0})".format(', '.join(usage))
+
+            report += [msg]
+
+        # Critical path: the chain of dependencies that took the longest
+        finish = {}
+        via    = {}
+        for name, r in steps.items():
+            deps = [d for d in r['deps'] if d in finish]
+            prev = max(deps, key = lambda d: finish[d]) if deps else None
+            finish[name] = r['wall'] + (0 if prev is None else finish[prev])
+            via[name]    = prev
+
+        name = max(finish.keys(), key = lambda n: finish[n])
+        chain = []
+        while name is not None:
+            chain = [name] + chain
+            name  = via[name]
+
+        msg     = "Critical path ({0:.1f}s):"
+        report += ["", msg.format(finish[chain[-1]])]
+        for name in chain:
+            report += ["\t{0:>9.1f}s  {1}".format(steps[name]['wall'], name)]
+
+        # Regressions relative to the median of previous builds
+        msg     = "Regressions (over {0:.0%} of median):"
+        report += ["", msg.format(threshold)]
+        regress = []
+        for name, r in steps.items():
+            walls = []
+            for build in list(builds.keys())[:-1]:
+                prev = builds[build].get(name)
+                if prev is not None and prev.get('status', 0) == 0:
+                    walls += [prev['wall']]
+
+            if walls == []:
+                continue
+
+            median = sorted(walls)[len(walls) // 2]
+            if r['wall'] > threshold * median and r['wall'] - median > 1:
+                msg = "\t{0:>9.1f}s  {1} (median {2:.1f}s over {3} builds)"
+                regress += [msg.format(r['wall'], name, median, len(walls))]
+
+        report += regress if regress != [] else ["\tNone"]
+        return report
+
+
 class MakeRules():
 
     """Various rules for file execution"""
@@ -1360,11 +2583,18 @@ class MakeRules():
             'python': {
                 'executable': "python",
                 'options': "",
+                'workers': False,
+                'preload': [],
             },
             'julia': {
                 'executable': "julia",
                 'options': "",
             },
+            'tablefill': {
+                'executable': "python",
+                'options': "",
+                'out_ext': [],
+            },
             'latex': {
                 'executable': "xelatex",
                 'options': "-synctex=1 -shell-escape",
@@ -1432,11 +2662,48 @@ class MakeRules():
         execlist   = [base_str.format(executable, opts, filename, args)]
         return execlist
 
-    def pythonParse(self, filename, args = '', opts = None, pre = ''):
-        executable = self.rules['python']['executable']
-        opts       = self.rules['python']['options'] if opts is None else opts
+    def pythonParse(self, filename,
+                    args    = '',
+                    opts    = None,
+                    pre     = '',
+                    workers = None,
+                    preload = None):
+        """Run python script 'filename'
+
+        With workers (the rule's 'workers' by default), the script runs
+        in a process forked from a python worker that has already
+        started and imported the modules in preload (see
+        run_python_worker), instead of in a new interpreter. The script
+        gets make.py's environment and stdin when it runs, but modules
+        are imported (and sys.path is set up) when the worker starts.
+        Commands that need a shell (options, a prefix, or arguments
+        with redirection, variables, globs, etc.) always run as usual.
+
+        Args:
+            filename (str): Script to run
+
+        Kwargs:
+            workers (bool): Run the script in a python worker
+            preload (list): Modules for the worker to import beforehand
+
+        Returns: List with the command to run
+
+        """
+        rule       = self.rules['python']
+        executable = rule['executable']
+        opts       = rule['options'] if opts is None else opts
+        workers    = rule.get('workers', False) if workers is None else workers
+        preload    = rule.get('preload', []) if preload is None else preload
         base_str   = (pre + ' {0} {1} "{2}" {3}').strip()
-        execlist   = [base_str.format(executable, opts, filename, args)]
+        execstr    = base_str.format(executable, opts, filename, args)
+        if workers and pre == '' and opts == '' and re_plain_args.match(args):
+            execstr = MakeWorkerCall(execstr, run_python_worker,
+                                     script     = filename,
+                                     args       = args,
+                                     executable = executable,
+                                     preload    = list(flatten([preload])))
+
+        execlist = [execstr]
         return execlist
 
     def juliaParse(self, filename, args = '', opts = None, pre = ''):
@@ -1446,6 +2713,53 @@ class MakeRules():
         execlist   = [base_str.format(executable, opts, filename, args)]
         return execlist
 
+    def tablefillParse(self, filename,
+                       args   = '',
+                       opts   = None,
+                       pre    = '',
+                       input  = None,
+                       output = None,
+                       **kwargs):
+        """Fill template 'filename' with tablefill in-process
+
+        The template is filled by calling tablefill() in make.py's
+        process (see run_tablefill), so there is no interpreter to
+        start, and input tables are only parsed once per target. The
+        command returned is the equivalent tablefill.py call, which is
+        what is printed, written by --gen-bash, and checked by the
+        build database.
+
+        Args:
+            filename (str): Template to fill
+
+        Kwargs:
+            input (str): Space-separated list of input files
+            output (str): Filled template
+            **kwargs: Other options passed to tablefill() (e.g. pvals)
+
+        Returns: List with the command to run
+
+        """
+        if input is None or output is None:
+            raise TypeError("tablefill rule needs 'input' and 'output'")
+
+        rule       = self.rules['tablefill']
+        executable = rule['executable']
+        opts       = rule['options'] if opts is None else opts
+        script     = path.join(path.dirname(path.abspath(__file__)),
+                               'tablefill.py')
+        inputs     = ' '.join(['"{0}"'.format(f) for f in input.split()])
+        base_str   = (pre + ' {0} {1} "{2}" "{3}" -i {4} -o "{5}" {6}')
+        execstr    = base_str.strip().format(executable, opts, script,
+                                             filename, inputs, output, args)
+        execlist   = [MakeCall(execstr,
+                               run_tablefill,
+                               template = filename,
+                               input    = input,
+                               output   = output,
+                               **kwargs)]
+        return execlist
+
 
 class MakefileDefaults():
 
@@ -1459,6 +2773,8 @@ class MakefileDefaults():
         self.guessrules = False  # Not yet implemented
         self.revision   = None   # Not yet implemented
         self.git_tag    = None   # Not yet implemented
+        self.builddb    = None   # e.g. '.makedb.json' to skip steps
+        self.history    = None   # e.g. '.makehistory.jsonl' for timings
 
         self.get = {
             'revision': None,
@@ -1477,6 +2793,9 @@ class MakefileDefaults():
             'rules': None,
             'rules_conf': None,
             'rules_kwargs': None,
+            'inputs': None,
+            'outputs': None,
+            'timeout': None,
             'tags': ["all"]
         }
 
@@ -1573,8 +2892,11 @@ class MakefileTodo(MakefileDefaults):
                 executable = None,
                 rules      = None,
                 options    = None,
-                out_ext    = [".log"],
+                out_ext    = None,
                 args       = "",
+                inputs     = None,
+                outputs    = None,
+                timeout    = None,
                 tags       = ["all"],
                 **kwargs):
         """Will run each filename in order.
@@ -1595,8 +2917,15 @@ class MakefileTodo(MakefileDefaults):
             rules (str or list): Rules to apply to 'filename'. If guessrules is
                                  True then rules are based off file extensions.
             options (str): Placed between 'executable' and 'filename'
-            out_ext (list): Output extension(s) to append to make.log
+            out_ext (list): Output extension(s) to append to make.log.
+                            Defaults to the rules' 'out_ext', or [".log"]
             args (str): Placed after 'filename'
+            inputs (str or list): Files read by 'filename'; used to run
+                                  independent steps in parallel (--jobs)
+            outputs (str or list): Files written by 'filename'; if given,
+                                   the step is skipped when its inputs,
+                                   commands and outputs are unchanged
+            timeout (float): Seconds after which to kill the step
             tags (list): Tags; will check if any tag in tags is requested
 
         Returns: Adds entry to 'run' dictionary.
@@ -1610,6 +2939,11 @@ class MakefileTodo(MakefileDefaults):
                 msg += "is set to 'False'"
                 raise TypeError(msg)
 
+        if out_ext is None:
+            out_ext = []
+            for rule in flatten([rules]):
+                out_ext += self.rules.get(rule, {}).get('out_ext', [".log"])
+
         self.run[self.counter] = {
             'file': filename,
             'executable': executable,
@@ -1618,6 +2952,9 @@ class MakefileTodo(MakefileDefaults):
             'oext': uniquelist(out_ext),
             'args': args,
             'rules': rules,
+            'inputs': inputs,
+            'outputs': outputs,
+            'timeout': timeout,
             'tags': tags
         }
 
@@ -1740,28 +3077,87 @@ class MakefileTodo(MakefileDefaults):
 
 class Logger():
 
-    """Hack to output everything to a log"""
+    """Hack to output everything to a log
 
-    def __init__(self, logfile = None):
+    Writes are buffered per thread until a line is complete and then
+    written under a lock, so lines from concurrent steps do not mix.
+    The log is flushed every 'interval' seconds, on flush(), and at
+    exit. If 'jsonlog' is given, record() writes one JSON object per
+    line to it.
+    """
+
+    def __init__(self, logfile = None, echo = True, interval = 2,
+                 jsonlog = None):
         if logfile is None:
             logfile = path.splitext(path.basename(sys.argv[0]))[0] + '.log'
 
         self.terminal = sys.stdout
-        self.log = open(logfile, 'w')
+        self.echo     = echo
+        self.log      = open(logfile, 'w', 65536)
+        self.jsonlog  = None if jsonlog is None else open(jsonlog, 'w')
+        self.lock     = RLock()
+        self.partial  = {}
+        self.interval = interval
+
+        flusher = Thread(target = self.autoflush)
+        flusher.daemon = True
+        flusher.start()
+        atexit.register(self.close)
 
     def write(self, message):
-        self.terminal.write(message)
-        self.log.write(message)
+        thread = current_thread().ident
+        with self.lock:
+            lines = (self.partial.pop(thread, '') + message).splitlines(True)
+            if lines != [] and not lines[-1].endswith(('\n', '\r')):
+                self.partial[thread] = lines.pop()
+
+            self.emit(''.join(lines))
+
+    def emit(self, text):
+        if text != '' and not self.log.closed:
+            if self.echo:
+                self.terminal.write(text)
+
+            self.log.write(text)
 
     def flush(self):
-        pass
+        with self.lock:
+            self.emit(self.partial.pop(current_thread().ident, ''))
+            if not self.log.closed:
+                self.log.flush()
+                if self.echo:
+                    self.terminal.flush()
+
+                if self.jsonlog is not None:
+                    self.jsonlog.flush()
+
+    def autoflush(self):
+        while not self.log.closed:
+            sleep(self.interval)
+            self.flush()
+
+    def record(self, **kwargs):
+        if self.jsonlog is not None:
+            with self.lock:
+                self.jsonlog.write(json.dumps(kwargs, sort_keys = True))
+                self.jsonlog.write('\n')
+
+    def close(self):
+        with self.lock:
+            for thread in list(self.partial.keys()):
+                self.emit(self.partial.pop(thread))
+
+            self.flush()
+            self.log.close()
+            if self.jsonlog is not None:
+                self.jsonlog.close()
 
 
 class AppendLogger():
 
     """Append logs to make.log, with markers"""
 
-    def __init__(self, loghandle):
+    def __init__(self, loghandle, maxsize = None, lock = None):
         head  = linesep
         head += '>' + 71 * '>' + linesep
         head += '> Log file: {0}' + linesep
@@ -1775,19 +3171,193 @@ class AppendLogger():
         self.loghandle = loghandle
         self.head      = head
         self.tail      = tail
+        self.maxsize   = maxsize
+        self.lock      = Lock() if lock is None else lock
+
+    def append(self, logfile, call, cwd = None):
+        """Copy logfile into make.log in chunks
+
+        If the log is over 'maxsize' bytes, only its tail is copied
+        (starting at the first full line). The log is read as bytes,
+        so it can be cut at any size; on Python 3 it is decoded as
+        UTF-8 (invalid bytes are replaced) as it is copied.
+
+        Args:
+            logfile (str): Log to append
+            call (str): Command that produced the log
+            cwd (str): Folder the command ran in (default: current)
+
+        Returns: Appends logfile to make.log
+
+        """
+        cwd     = getcwd() if cwd is None else cwd
+        headstr = self.head.format(logfile, call, cwd)
+        logpath = path.join(cwd, logfile)
+        size    = path.getsize(logpath)
+        if version_info >= (3, 0):
+            decode = getincrementaldecoder('utf-8')('replace').decode
+        else:
+            decode = lambda chunk, final = False: chunk  # noqa
+
+        with open(logpath, 'rb') as log:
+            with self.lock:
+                self.loghandle.write(headstr)
+                if self.maxsize is not None and size > self.maxsize:
+                    log.seek(size - self.maxsize)
+                    log.readline()
+                    msg = "[... first {0} bytes of '{1}' not shown ...]"
+                    msg = msg.format(log.tell(), logfile)
+                    self.loghandle.write(msg + linesep + linesep)
+
+                chunk = log.read(1048576)
+                while chunk:
+                    self.loghandle.write(decode(chunk))
+                    chunk = log.read(1048576)
+
+                self.loghandle.write(decode(b'', True))
+                self.loghandle.write(self.tail)
+
+
+class MakeCall(str):
+
+    """Command that make.py runs by calling a python function
+
+    The string is the equivalent shell command, which is what gets
+    printed, written by --gen-bash and stored in the build database.
+    """
+
+    def __new__(cls, execstr, func, **kwargs):
+        self = str.__new__(cls, execstr)
+        self.func   = func
+        self.kwargs = kwargs
+        return self
+
+    def call(self, cwd = None, timeout = None, prefix = ''):
+        """Call the function with working directory 'cwd'
+
+        The function gets 'cwd' as a keyword argument (this must not
+        change the working directory, since steps may run in threads)
+        and returns an exit status. Exceptions are printed and give
+        exit status 1. Functions cannot be timed out, so 'timeout' and
+        'prefix' are ignored.
+
+        Returns: Same as run_command; CPU time and peak memory are
+                 those of the whole make.py process
+
+        """
+        start = time()
+        times = os_times()
+        try:
+            status = self.func(cwd = cwd, **self.kwargs)
+        except:
+            print(format_exc())
+            status = 1
+
+        if getrusage is None:
+            maxrss = 0
+        else:
+            maxrss = getrusage(RUSAGE_SELF).ru_maxrss
+
+        maxrss = maxrss / 1024.0 if sys.platform == 'darwin' else maxrss
+        cpu    = sum(os_times()[:2]) - sum(times[:2])
+        return {
+            'status': status,
+            'timeout': False,
+            'start': start,
+            'wall': time() - start,
+            'cpu': cpu,
+            'maxrss': maxrss
+        }
+
 
-    def append(self, logfile, call):
-        headstr = self.head.format(logfile, call, getcwd())
-        append  = [headstr] + open(logfile).readlines() + [self.tail]
-        for line in append:
-            self.loghandle.write(line)
+class MakeWorkerCall(MakeCall):
 
-        sleep(1)
+    """Command that make.py runs in a python worker
+
+    Unlike MakeCall, the function runs the command somewhere else,
+    measures it, and returns the same as run_command.
+    """
+
+    def call(self, cwd = None, timeout = None, prefix = ''):
+        """Call the function; see run_python_worker"""
+        start = time()
+        try:
+            return self.func(cwd     = cwd,
+                             timeout = timeout,
+                             prefix  = prefix,
+                             **self.kwargs)
+        except:
+            print(format_exc())
+            return {
+                'status': 1,
+                'timeout': False,
+                'start': start,
+                'wall': time() - start,
+                'cpu': 0,
+                'maxrss': 0
+            }
 
 
 # ---------------------------------------------------------------------
 # Aux functions
 
+# Run a single target in a child process; see run_target_process
+def run_target_child(args, target, logfile, send):
+    make = MakeInternals()
+    make.set_options()
+    make.args.update(args)
+    make.args['targets'] = [target]
+    make.targets = [target]
+    make.ntargs  = 1
+    make.logfile = logfile
+
+    if make.args['json_log']:
+        jsonlog = path.splitext(logfile)[0] + '.jsonl'
+    else:
+        jsonlog = None
+
+    # With --nolog the child prints straight to make.py's output
+    if not make.args['nolog']:
+        sys.stdout     = Logger(logfile = logfile, echo = False,
+                                jsonlog = jsonlog)
+        make.loghandle = sys.stdout.log
+        make.log       = AppendLogger(make.loghandle,
+                                      maxsize = make.args['log_tail'],
+                                      lock    = sys.stdout.lock)
+    try:
+        make.run_target(target)
+        status = 0
+    except BaseException:
+        print(format_exc())
+        status = 1
+
+    if make.args['nolog']:
+        sys.stdout.flush()
+    else:
+        sys.stdout.close()
+
+    send.send((status, make.timestampts.get(target, OrderedDict())))
+    send.close()
+
+
+# Seconds since the epoch from Stata's c(current_date) and
+# c(current_time) (e.g. ' 8 Oct 2026 19:09:01'); None if unreadable.
+# Parsed by hand since strptime is locale-dependent (and not thread
+# safe on first use in python 2).
+def stata_time(stamp):
+    months = ['jan', 'feb', 'mar', 'apr', 'may', 'jun',
+              'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+    match  = re.match(r'\s*(\d+) (\w+) (\d+) (\d+):(\d+):(\d+)', stamp)
+    if match is None or match.group(2).lower() not in months:
+        return None
+
+    day, month, year, hour, minute, second = match.groups()
+    month = months.index(month.lower()) + 1
+    stamp = (int(year), month, int(day), int(hour), int(minute),
+             int(second), 0, 0, -1)
+    return mktime(stamp)
+
+
 # Backwards-compatible list flattening
 # http://stackoverflow.com/questions/2158395/
 def flatten(l):
@@ -1807,11 +3377,486 @@ def flatten(l):
                 yield el
 
 
+# Run a shell command, writing its output to stdout as it is printed;
+# returns exit status, wall and CPU seconds, and peak memory (KB). If
+# the command takes over 'timeout' seconds, its process group is sent
+# SIGTERM (SIGKILL 10 seconds later) and 'timeout' is set to True. If
+# make.py is interrupted (Ctrl-C or SIGTERM) while waiting, the process
+# group is sent SIGTERM and the exception is re-raised. On Windows, only
+# the shell is stopped and CPU and memory are reported as 0.
+def run_command(execstr, cwd = None, timeout = None, prefix = ''):
+    # The command gets its own session (and process group) so it can
+    # be stopped as a whole; it does not see the terminal's Ctrl-C, so
+    # it is stopped here instead. Python 2 has no start_new_session; there
+    # setsid is called with preexec_fn, which is not thread-safe in
+    # general, but os.setsid is a plain system call that does not run
+    # python code or take locks in the child.
+    if version_info >= (3, 2):
+        session = {'start_new_session': True}
+    elif setsid is not None:
+        session = {'preexec_fn': setsid}
+    else:
+        session = {}
+
+    start = time()
+    proc  = Popen(execstr,
+                  shell      = True,
+                  cwd        = cwd,
+                  stdout     = PIPE,
+                  stderr     = STDOUT,
+                  universal_newlines = True,
+                  **session)
+
+    timedout = []
+    timers   = []
+
+    def kill(signum, timed = True):
+        try:
+            if killpg is None:
+                proc.kill()
+            else:
+                killpg(proc.pid, signum)
+
+            if timed:
+                timedout.append(signum)
+        except OSError:
+            pass
+
+    def stop():
+        kill(signal.SIGTERM, False)
+
+    if timeout is not None:
+        sigkill = getattr(signal, 'SIGKILL', signal.SIGTERM)
+        timers += [Timer(timeout, kill, [signal.SIGTERM])]
+        timers += [Timer(timeout + 10, kill, [sigkill])]
+        for t in timers:
+            t.daemon = True
+            t.start()
+
+    track_command(stop)
+    try:
+        for line in iter(proc.stdout.readline, ''):
+            sys.stdout.write(prefix + line)
+
+        proc.stdout.close()
+        if wait4 is None:
+            status = proc.wait()
+            cpu    = maxrss = 0
+        else:
+            pid, wstatus, usage = wait4(proc.pid, 0)
+            if WIFEXITED(wstatus):
+                status = WEXITSTATUS(wstatus)
+            else:
+                status = -WTERMSIG(wstatus)
+
+            proc.returncode = status
+            cpu    = usage.ru_utime + usage.ru_stime
+            maxrss = usage.ru_maxrss
+            maxrss = maxrss / 1024.0 if sys.platform == 'darwin' else maxrss
+    except:
+        stop()
+        raise
+    finally:
+        untrack_command(stop)
+        for t in timers:
+            t.cancel()
+
+    return {
+        'status': status,
+        'timeout': timedout != [],
+        'start': start,
+        'wall': time() - start,
+        'cpu': cpu,
+        'maxrss': maxrss
+    }
+
+
+# Stop all commands that are running, and any started from now on (they
+# are stopped as soon as they start); used when make.py is interrupted
+# while steps run in threads. Commands register a function that stops
+# them with track_command while they run.
+def stop_commands():
+    with running_lock:
+        running_stopped.set()
+        stops = list(running_commands)
+
+    for stop in stops:
+        stop()
+
+
+def track_command(stop):
+    with running_lock:
+        running_commands.add(stop)
+        stopped = running_stopped.is_set()
+
+    if stopped:
+        stop()
+
+
+def untrack_command(stop):
+    with running_lock:
+        running_commands.discard(stop)
+
+
+running_commands = set()
+running_lock     = Lock()
+running_stopped  = Event()
+
+
+# Fill a template with tablefill in this process (see tablefillParse);
+# tables parsed from input files with the same contents are shared
+# between calls. Returns the exit status tablefill.py would have.
+def run_tablefill(template, input, output, cwd = None, **kwargs):
+    try:
+        from tablefill import tablefill, load_input_tables
+    except ImportError:
+        sys.path.insert(0, path.dirname(path.abspath(__file__)))
+        from tablefill import tablefill, load_input_tables
+
+    # Paths are relative to 'cwd', as when tablefill.py runs there
+    cwd     = getcwd() if cwd is None else cwd
+    infiles = [path.join(cwd, f) for f in input.split()]
+    if kwargs.get('cache') is not None:
+        kwargs['cache'] = path.join(cwd, kwargs['cache'])
+
+    if kwargs.get('xml_tables') is not None:
+        xml_tables = flatten([kwargs['xml_tables']])
+        kwargs['xml_tables'] = [path.join(cwd, f) for f in xml_tables]
+
+    key = []
+    for infile in infiles:
+        with open(infile, 'rb') as fhandle:
+            key += [(infile, hashlib.sha1(fhandle.read()).hexdigest())]
+
+    key = tuple(key)
+    with tablefill_lock:
+        if key in tablefill_tables:
+            tables = tablefill_tables.pop(key)
+        else:
+            cache  = kwargs.get('cache', None)
+            tables = load_input_tables(infiles, cache)
+
+        # Keep the most recently used tables last; drop the oldest
+        tablefill_tables[key] = tables
+        while len(tablefill_tables) > tablefill_max_tables:
+            tablefill_tables.popitem(last = False)
+
+    kwargs['verbose'] = kwargs.get('verbose', False)
+    exit, exit_msg = tablefill(template = path.join(cwd, template),
+                               input    = ' '.join(infiles),
+                               output   = path.join(cwd, output),
+                               tables   = tables,
+                               **kwargs)
+
+    # tablefill.py exits with -1 on warnings
+    return {'SUCCESS': 0, 'WARNING': 255, 'ERROR': 1}[exit]
+
+
+tablefill_tables     = OrderedDict()
+tablefill_max_tables = 16
+tablefill_lock       = Lock()
+
+
+# Run a python script in a python worker (see pythonParse): the script
+# runs with runpy in a process forked from a worker that has already
+# imported the modules in 'preload', with 'cwd' as its working
+# directory, sys.argv set from 'args', make.py's current environment and
+# stdin, and its output written to stdout as with run_command. Returns
+# the same as run_command.
+def run_python_worker(script, args, executable, preload,
+                      cwd = None, timeout = None, prefix = ''):
+    start   = time()
+    sockets = python_worker(executable, preload)
+    request = {
+        'cwd': getcwd() if cwd is None else cwd,
+        'argv': [script] + shlex.split(args),
+        'env': dict(environ),
+        'timeout': timeout
+    }
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(sockets)
+    conn.sendall((json.dumps(request) + '\n').encode('utf-8'))
+
+    # Output is followed by a null byte and the exit status as JSON
+    def write(output):
+        for line in output.split(b'\n'):
+            if version_info >= (3, 0):
+                line = line.decode('utf-8', 'replace')
+
+            sys.stdout.write(prefix + line + '\n')
+
+    # Closing the connection early stops the script (see stop_commands)
+    def stop():
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    buf = b''
+    track_command(stop)
+    try:
+        for chunk in iter(lambda: conn.recv(65536), b''):
+            head, null, tail = (buf + chunk).partition(b'\0')
+            lines = head.rsplit(b'\n', 1)
+            if len(lines) > 1:
+                write(lines[0])
+
+            buf = lines[-1] + null + tail
+    except:
+        stop()
+        raise
+    finally:
+        untrack_command(stop)
+        conn.close()
+    output, null, status = buf.rpartition(b'\0')
+    if null == b'':
+        output = status
+        result = {'status': 1, 'timeout': False, 'cpu': 0, 'maxrss': 0}
+    else:
+        result = json.loads(status.decode('utf-8'))
+
+    if output != b'':
+        write(output)
+
+    result['start'] = start
+    result['wall']  = time() - start
+    return result
+
+
+# Start (once) a python worker for 'executable' that imports 'preload';
+# returns the path of the socket it listens on. Workers share make.py's
+# stdin (scripts read it as they would if run by run_command), and exit
+# (and remove their files) when the write end of a pipe passed to them
+# is closed, i.e. when make.py exits.
+def python_worker(executable, preload):
+    from os import pipe, close
+    import fcntl
+
+    key = (executable, tuple(preload))
+    with python_workers_lock:
+        if key in python_workers:
+            proc, tmpdir, stop = python_workers[key]
+            if proc.poll() is None:
+                return path.join(tmpdir, 'socket')
+
+            close(stop)
+            rmtree(tmpdir, ignore_errors = True)
+
+        tmpdir  = mkdtemp(prefix = 'make-python-')
+        server  = path.join(tmpdir, 'worker.py')
+        sockets = path.join(tmpdir, 'socket')
+        with open(server, 'w') as shandle:
+            shandle.write(python_worker_server)
+
+        # Only the worker gets the read end; no process gets the write
+        # end, or the worker would not see it close
+        wait, stop = pipe()
+        fcntl.fcntl(stop, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        if version_info >= (3, 2):
+            keep = {'pass_fds': (wait,)}
+        else:
+            keep = {'close_fds': False}
+
+        modules = ' '.join(['"{0}"'.format(m) for m in preload])
+        execstr = '{0} "{1}" "{2}" {3} {4}'.format(executable, server,
+                                                  sockets, wait, modules)
+        with open(devnull, 'w') as null:
+            proc = Popen(execstr,
+                         shell  = True,
+                         stdout = null,
+                         stderr = null,
+                         **keep)
+
+        close(wait)
+        python_workers[key] = (proc, tmpdir, stop)
+        while not path.exists(sockets):
+            if proc.poll() is not None:
+                msg = "Could not start a python worker with `{0}`"
+                raise OSError(msg.format(execstr))
+
+            sleep(0.01)
+
+        return sockets
+
+
+# Stop all python workers and remove their files
+def stop_python_workers():
+    from os import close
+
+    with python_workers_lock:
+        for proc, tmpdir, stop in python_workers.values():
+            close(stop)
+            proc.wait()
+            rmtree(tmpdir, ignore_errors = True)
+
+        python_workers.clear()
+
+
+python_workers      = {}
+python_workers_lock = Lock()
+atexit.register(stop_python_workers)
+
+# Arguments that can be passed to a python worker without a shell
+re_plain_args = re.compile(r'^[^|&;<>()$`\\*?~{}\[\]!#]*$')
+
+# Python worker (see python_worker). It forks a process for each
+# request; that process forks the script's, waits for it (stopping it
+# after the request's timeout, if any), and sends back its exit status.
+python_worker_server = r'''
+import errno
+import json
+import os
+import runpy
+import shutil
+import select
+import signal
+import socket
+import sys
+
+stop = int(sys.argv[2])
+for module in sys.argv[3:]:
+    try:
+        __import__(module)
+    except Exception:
+        pass
+
+
+# JSON gives text; python 2 wants bytes in sys.argv and os.environ
+def native(text):
+    if sys.version_info[0] < 3:
+        return text.encode('utf-8')
+
+    return text
+
+
+def serve(conn):
+    request = b''
+    while not request.endswith(b'\n'):
+        chunk = conn.recv(65536)
+        if chunk == b'':
+            return
+
+        request += chunk
+
+    request = json.loads(request.decode('utf-8'))
+    pid     = os.fork()
+    if pid == 0:
+        os.setsid()
+        os.close(stop)
+        os.environ.clear()
+        for name, value in request['env'].items():
+            os.environ[native(name)] = native(value)
+
+        os.chdir(native(request['cwd']))
+        os.dup2(conn.fileno(), 1)
+        os.dup2(conn.fileno(), 2)
+        conn.close()
+        sys.argv    = [native(arg) for arg in request['argv']]
+        sys.path[0] = os.path.dirname(os.path.abspath(sys.argv[0]))
+        script      = sys.argv[0]
+        runpy.run_path(script, run_name = '__main__')
+        sys.exit(0)
+
+    def kill(signum, frame):
+        try:
+            os.killpg(pid, signal.SIGKILL if killed else signal.SIGTERM)
+        except OSError:
+            pass
+
+        killed.append(signum)
+        signal.setitimer(signal.ITIMER_REAL, 10)
+
+    killed = []
+    signal.signal(signal.SIGALRM, kill)
+    if request['timeout'] is not None:
+        signal.setitimer(signal.ITIMER_REAL, request['timeout'])
+
+    # make.py closes the connection if it is interrupted; the script is
+    # then stopped as on a timeout
+    gone = False
+    while True:
+        try:
+            ready = select.select([] if gone else [conn], [], [], 0.1)[0]
+            done, wstatus, usage = os.wait4(pid, os.WNOHANG)
+        except (OSError, select.error) as error:
+            if error.args[0] != errno.EINTR:
+                raise
+
+            continue
+
+        if done == pid:
+            break
+        elif ready:
+            gone = True
+            kill(None, None)
+
+    signal.setitimer(signal.ITIMER_REAL, 0)
+    if os.WIFEXITED(wstatus):
+        status = os.WEXITSTATUS(wstatus)
+    else:
+        status = -os.WTERMSIG(wstatus)
+
+    maxrss = usage.ru_maxrss
+    maxrss = maxrss / 1024.0 if sys.platform == 'darwin' else maxrss
+    result = {
+        'status': status,
+        'timeout': killed != [],
+        'cpu': usage.ru_utime + usage.ru_stime,
+        'maxrss': maxrss
+    }
+    try:
+        conn.sendall(b'\0' + json.dumps(result).encode('utf-8'))
+    except socket.error:
+        pass
+
+
+server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+server.bind(sys.argv[1])
+server.listen(64)
+signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+while True:
+    ready = select.select([server, stop], [], [])[0]
+    if stop in ready:
+        break
+
+    conn = server.accept()[0]
+    if os.fork() == 0:
+        server.close()
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        serve(conn)
+        os._exit(0)
+
+    conn.close()
+
+server.close()
+shutil.rmtree(os.path.dirname(sys.argv[1]), ignore_errors = True)
+'''
+
+
 # Return a flattened list of unique items
 def uniquelist(x):
     return list(set(flatten([x])))
 
 
+# Return a flattened list of file names, dropping None
+def filelist(x):
+    return [f for f in flatten([x]) if f is not None]
+
+
+# Whether any path in x is the same as or inside any path in y (or
+# vice versa); paths should be normalized
+def overlap(x, y):
+    for a in x:
+        for b in y:
+            if a == b:
+                return True
+            elif a.startswith(b + sep) or b.startswith(a + sep):
+                return True
+
+    return False
+
+
 # Recursively make a directory; check if it already exists
 def makedirs_safe(directory):
     try:
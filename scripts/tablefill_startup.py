@@ -0,0 +1,63 @@
+#! /usr/bin/env python
+# Benchmark how long a plain tablefill run takes, start to finish, and
+# issue a non-zero return code if the median is over budget.
+#
+# Usage:
+#   python scripts/tablefill_startup.py [RUNS] [BUDGET_MS]
+#
+# Each run fills a one-table template in a fresh interpreter, which is
+# how make.py pipelines call tablefill. The time to import tablefill
+# is also reported, separately.
+
+from __future__ import division, print_function
+from subprocess import check_call
+from tempfile import mkdtemp
+from shutil import rmtree
+from os import path, devnull
+from time import time
+import sys
+
+tablefill = path.join(path.dirname(path.abspath(__file__)),
+                      '..', 'tablefill.py')
+tablefill = path.abspath(tablefill)
+runs      = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+budget    = float(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+
+def median_ms(command):
+    times = []
+    with open(devnull, 'w') as null:
+        for i in range(runs):
+            start = time()
+            check_call(command, stdout = null)
+            times += [1000 * (time() - start)]
+
+    return sorted(times)[len(times) // 2]
+
+
+tmpdir = mkdtemp()
+try:
+    template = path.join(tmpdir, 'template.tex')
+    inputs   = path.join(tmpdir, 'table.txt')
+    output   = path.join(tmpdir, 'filled.tex')
+    with open(template, 'w') as fhandle:
+        fhandle.write("\\begin{table}\n\\label{tab:test}\n")
+        fhandle.write("#2# & #1,# & ### & #*# \\\\\n\\end{table}\n")
+
+    with open(inputs, 'w') as fhandle:
+        fhandle.write("<tab:test>\n1.2345\t1234.5\tfoo\t0.03\n")
+
+    command = [sys.executable, tablefill, template,
+               '-i', inputs, '-o', output, '--silent']
+    fill    = median_ms(command)
+    empty   = median_ms([sys.executable, '-c', 'pass'])
+    imports = median_ms([sys.executable, '-c',
+                         "import sys; sys.path.insert(0, %r);"
+                         " import tablefill" % path.dirname(tablefill)])
+finally:
+    rmtree(tmpdir)
+
+print("python startup:   %6.1f ms" % empty)
+print("import tablefill: %6.1f ms" % (imports - empty))
+print("plain fill:       %6.1f ms (budget %.0f ms)" % (fill, budget))
+sys.exit(0 if fill <= budget else 1)
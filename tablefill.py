@@ -35,7 +35,8 @@ optional arguments:
   -h, --help            show this help message and exit
   -v, --version         Show current version
   -i [INPUT [INPUT ...]], --input [INPUT [INPUT ...]]
-                        Input files with tables (default: INPUT_table)
+                        Input files with tables (.txt, or .npz/.npy with
+                        numpy) (default: INPUT_table)
   -o OUTPUT, --output OUTPUT
                         Processed template file (default: INPUT_filled)
   -t {auto,lyx,tex}, --type {auto,lyx,tex}
@@ -46,6 +47,8 @@ optional arguments:
                         Stars for sig thresholds (enclose each entry in quotes)
   --xml-tables [INPUT [INPUT ...]]
                         Files with custom xml combinations.
+  --cache [DIR]         Cache parsed inputs in DIR (default: .tablefill_cache),
+                        keeping the 512 most recently used files
 
 flags:
   -f, --force           Name input/output automatically
@@ -55,6 +58,11 @@ flags:
   --numpy-syntax        Numpy syntax for custom XML tables.
   --use-floats          Force floats when passing objects to custom XML python.
   --ignore-xml          Ignore XML in template comments.
+  --incremental         Only re-fill tables that changed
+  --batch               TEMPLATE is a manifest with lines
+                        'TEMPLATE OUTPUT [INPUT ...]'
+  --processes PROCESSES
+                        Processes to use with --batch
   --verbose             Verbose printing (for debugging)
   --silent              Try to say nothing
 
@@ -81,6 +89,10 @@ test.tex
 test_table.txt
 test_filled.txt
 $ python tablefill.py test.tex -i test_table.txt -o output.tex --verbose
+$ cat tables.txt
+test.tex output.tex
+other.tex other_filled.tex other_table.txt
+$ python tablefill.py tables.txt --batch -i test_table.txt --processes 2
 
 Notes
 -----
@@ -99,22 +111,41 @@ available to me come with python 2.6).
 
 from __future__ import division, print_function
 from os import linesep, path, access, W_OK, system, chdir, remove
-from decimal import Decimal, ROUND_HALF_UP
+from os import makedirs, rename, listdir, stat, chmod, utime, umask
+from os import fdopen, close, curdir
 from collections import Iterable as Iter
 from traceback import format_exc
 from operator import itemgetter
+from bisect import bisect_right
 from sys import exit as sysexit
 from sys import version_info
-from tempfile import mktemp
-import xml.etree.ElementTree as xml
+from tempfile import mkstemp, TemporaryFile
+from shutil import copyfileobj
+from hashlib import sha1
 import argparse
+import filecmp
+import marshal
 import math
 import re
+# numpy, xml.etree, decimal, ast, and shlex are imported when they are
+# first needed, since most fills use none of them and tablefill is
+# often run many times in a build (see import_numpy)
+numpy   = None
+numpyok = None
+
+# --cache keeps this many files (the least recently used are removed)
+cache_max_files = 512
+cache_suffixes  = ('.marshal', '.plan')
+
+# mkstemp files are private; new files get the usual permissions instead
+# (os.umask can only be read by setting it, so it is read once here)
+file_umask = umask(0)
+umask(file_umask)
+
 try:
-    import numpy
-    numpyok = True
-except:
-    numpyok = False
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
 
 __program__   = "tablefill.py"
 __usage__     = """[-h] [-v] [FLAGS] [-i [INPUT [INPUT ...]]] [-o OUTPUT]
@@ -142,6 +173,33 @@ def main():
     fill.get_input_parser()
     fill.get_parsed_arguments()
     fill.get_argument_strings()
+    if fill.args.batch:
+        print_verbose(fill.verbose, "Arguments look OK. Will run batch.")
+        results = tablefill_batch(manifest       = fill.template,
+                                  input          = fill.input,
+                                  processes      = fill.args.processes,
+                                  filetype       = fill.args.filetype[0],
+                                  verbose        = fill.verbose,
+                                  silent         = fill.silent,
+                                  pvals          = fill.pvals,
+                                  stars          = fill.stars,
+                                  fillc          = fill.fillc,
+                                  legacy_parsing = fill.legacy_parsing,
+                                  numpy_syntax   = fill.numpy_syntax,
+                                  use_floats     = fill.use_floats,
+                                  ignore_xml     = fill.ignore_xml,
+                                  xml_tables     = fill.xml_tables,
+                                  cache          = fill.cache,
+                                  incremental    = fill.incremental)
+
+        exits = [exit for template, exit, exit_msg in results]
+        if 'ERROR' in exits:
+            sysexit(1)
+        elif 'WARNING' in exits:
+            sysexit(-1)
+        else:
+            sysexit(0)
+
     fill.get_file_type()
     print_verbose(fill.verbose, "Arguments look OK. Will run tablefill.")
 
@@ -158,7 +216,9 @@ def main():
                                numpy_syntax   = fill.numpy_syntax,
                                use_floats     = fill.use_floats,
                                ignore_xml     = fill.ignore_xml,
-                               xml_tables     = fill.xml_tables)
+                               xml_tables     = fill.xml_tables,
+                               cache          = fill.cache,
+                               incremental    = fill.incremental)
 
     if exit == 'SUCCESS':
         fill.get_compiled()
@@ -177,6 +237,23 @@ def main():
         sysexit(1)
 
 
+def import_numpy():
+    """
+    Import numpy the first time it is needed. Sets the module globals
+    numpy and numpyok (whether the import worked) and returns numpyok.
+    """
+    global numpy, numpyok
+    if numpyok is None:
+        try:
+            import numpy
+            numpyok = True
+            custom_globals['numpy'] = numpy
+        except:
+            numpyok = False
+
+    return numpyok
+
+
 # Backwards-compatible string formatting
 def compat_format(x):
     if version_info >= (2, 7):
@@ -242,6 +319,400 @@ def nested_convert(item, func):
     return custom_convert(item, func)
 
 
+def nested_float(item):
+    return nested_convert(item, float)
+
+
+def format_numbers(entries,
+                   precision,
+                   percent  = False,
+                   absolute = False,
+                   comma    = False):
+    """
+    Round a list of numbers (as strings) to 'precision' decimals with
+    ROUND_HALF_UP, optionally as percentages, in absolute value, and
+    with commas as thousands separators. Plain decimal entries are
+    rounded on their digits directly, which gives the same result as
+    Decimal's quantize; anything else (exponents, very long numbers,
+    more than 6 decimals) goes through Decimal.
+    """
+    formatted = []
+    for entry in entries:
+        match = re_plain_number.match(entry)
+        if match and precision <= 6 and len(entry) <= 24 and \
+                (match.group(2) or match.group(3)):
+            sign, integer_part, decimal_part = match.groups()
+            sign         = '' if absolute or sign != '-' else '-'
+            decimal_part = decimal_part or ''
+            if percent:
+                decimal_part  = decimal_part.ljust(2, '0')
+                integer_part += decimal_part[:2]
+                decimal_part  = decimal_part[2:]
+
+            decimal_part = decimal_part.ljust(precision, '0')
+            digits = int((integer_part + decimal_part[:precision]) or '0')
+            if decimal_part[precision:precision + 1] >= '5':
+                digits += 1
+
+            digits = str(digits).rjust(precision + 1, '0')
+            if precision > 0:
+                decimal_part = '.' + digits[-precision:]
+                integer_part = digits[:-precision]
+            else:
+                decimal_part = ''
+                integer_part = digits
+
+            if comma:
+                integer_part = compat_format(int(integer_part))
+
+            formatted += [sign + integer_part + decimal_part]
+        else:
+            formatted += [format_number_decimal(entry,
+                                                precision,
+                                                percent,
+                                                absolute,
+                                                comma)]
+
+    return formatted
+
+
+def format_number_decimal(entry, precision, percent, absolute, comma):
+    """
+    Round entry using Decimal (see format_numbers). Note Decimal's
+    quantize makes the object have the same number of significant
+    digits as the input passed. format(str, ',d') returns str with
+    comma as thousands separator.
+    """
+    from decimal import Decimal, ROUND_HALF_UP
+    roundas = 0 if precision == 0 else pow(10, -precision)
+    roundas = Decimal(str(roundas))
+    dentry  = 100 * Decimal(entry) if percent else Decimal(entry)
+    dentry  = abs(dentry) if absolute else dentry
+    rounded = str(dentry.quantize(roundas, rounding = ROUND_HALF_UP))
+    if comma:
+        matchc  = re.search('(-?\d+)(\.?\d*)', rounded)
+        integer_part, decimal_part = matchc.groups()
+        neg     = '-' if integer_part.startswith('-0') else ''
+        rounded = neg + compat_format(int(integer_part)) + decimal_part
+
+    return rounded
+
+
+re_plain_number = re.compile('^\s*([+-]?)(\d*)(?:\.(\d*))?\s*$')
+
+
+def parse_input_tables(infiles):
+    """
+    Parse table file(s) into a dictionary with tags as keys and lists
+    of table rows (lists of entries) as values. Files ending in .npz
+    or .npy are read with parse_numpy_tables.
+    """
+    tags    = re.compile('^<Tab:(.+)>' + linesep, flags = re.IGNORECASE)
+    ctables = {}
+    for infile in infiles:
+        if path.splitext(infile)[1].lower() in ['.npz', '.npy']:
+            ctables.update(parse_numpy_tables(infile))
+            continue
+
+        for row in open(infile, 'rU'):
+            match = tags.match(row)
+            if match:
+                tag = match.group(1).lower()
+                ctables[tag] = []
+            else:
+                clean_row_entries = [e.strip() for e in row.split('\t')]
+                ctables[tag] += [clean_row_entries]
+
+    return ctables
+
+
+def parse_numpy_tables(infile):
+    """
+    Read tables from a numpy .npz file, with one array per tag, or from
+    a .npy file with a single array tagged with the file's name. Arrays
+    with more than 2 dimensions are flattened into one row per element
+    of the first dimension.
+    """
+    if not import_numpy():
+        numpy_msg  = "Reading '%s' requires numpy but python failed to"
+        numpy_msg += " import numpy."
+        raise Warning(numpy_msg % infile)
+
+    if path.splitext(infile)[1].lower() == '.npy':
+        tag    = path.splitext(path.basename(infile))[0]
+        arrays = [(tag, numpy.load(infile))]
+    else:
+        with numpy.load(infile) as npz:
+            arrays = [(tag, npz[tag]) for tag in npz.files]
+
+    ctables = {}
+    for tag, array in arrays:
+        if array.ndim != 2:
+            rows  = array.shape[0] if array.ndim > 2 else 1
+            array = array.reshape(rows, -1)
+
+        # numpy formats floats with the shortest string that
+        # round-trips, as they would be written to a text table
+        ctables[tag.lower()] = [[str(x) for x in row] for row in array]
+
+    return ctables
+
+
+def load_input_tables(infiles, cache = None):
+    """
+    Parse table file(s) as in parse_input_tables. If 'cache' is a
+    directory, the parsed tables are stored there in marshal format,
+    keyed on the names and contents of the input files and the
+    tablefill and python versions, and are loaded from there if the
+    inputs have not changed.
+    """
+    if cache is None:
+        return parse_input_tables(infiles)
+
+    # File names matter as well as contents (.npy tables are tagged with
+    # the file's name, and the extension picks the parser)
+    key = sha1((__version__ + str(version_info[:2])).encode())
+    for infile in infiles:
+        name = path.basename(infile)
+        name = name if isinstance(name, bytes) else name.encode('utf-8')
+        key.update(sha1(name).digest())
+        with open(infile, 'rb') as fhandle:
+            key.update(sha1(fhandle.read()).digest())
+
+    cachefile = path.join(cache, key.hexdigest() + '.marshal')
+    ctables   = read_cache(cachefile)
+    if ctables is None:
+        ctables = parse_input_tables(infiles)
+        write_cache(cachefile, ctables)
+
+    return ctables
+
+
+def open_atomic(fname):
+    """
+    Open a new temporary file for writing in the folder of 'fname', to
+    be renamed to 'fname' once complete so readers never see partial
+    output. Returns the open file and its name. The file gets the
+    permissions of 'fname' if it exists, and those of a new file
+    otherwise, rather than the private ones mkstemp uses.
+    """
+    fd, tmpfile = mkstemp(prefix = '.tmp', dir = path.dirname(fname) or curdir)
+    try:
+        if path.exists(fname):
+            chmod(tmpfile, stat(fname).st_mode & 0o7777)
+        else:
+            chmod(tmpfile, 0o666 & ~file_umask)
+
+        return fdopen(fd, 'wb'), tmpfile
+    except:
+        close(fd)
+        remove(tmpfile)
+        raise
+
+
+def read_cache(cachefile):
+    """
+    Load an object stored by write_cache, or None if there is no
+    readable cache file. Hits update the file's modification time, so
+    the cache keeps the most recently used files.
+    """
+    try:
+        with open(cachefile, 'rb') as fhandle:
+            cached = marshal.load(fhandle)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+
+    try:
+        utime(cachefile, None)
+    except OSError:
+        pass
+
+    return cached
+
+
+def write_cache(cachefile, obj):
+    """
+    Store 'obj' in 'cachefile' in marshal format (see open_atomic) and
+    remove the oldest cache files in its folder past cache_max_files.
+    """
+    cache = path.dirname(cachefile)
+    try:
+        makedirs(cache)
+    except OSError:
+        if not path.isdir(cache):
+            raise
+
+    # We only ever remove our own mkstemp file if the write fails
+    fhandle, tmpfile = open_atomic(cachefile)
+    try:
+        with fhandle:
+            marshal.dump(obj, fhandle)
+
+        rename(tmpfile, cachefile)
+    except:
+        remove(tmpfile)
+        raise
+
+    cached = []
+    for fname in listdir(cache):
+        if fname.endswith(cache_suffixes):
+            try:
+                fname = path.join(cache, fname)
+                cached.append((stat(fname).st_mtime, fname))
+            except OSError:
+                pass
+
+    cached.sort(reverse = True)
+    for mtime, fname in cached[cache_max_files:]:
+        try:
+            remove(fname)
+        except OSError:
+            pass
+
+
+def compile_custom_table(text):
+    """
+    Compile the python expression of a custom table. Only indexing,
+    slicing, arithmetic, comparisons, and calls to a few builtins,
+    numpy functions and array methods are allowed (SyntaxError
+    otherwise), so templates cannot import modules, open files or
+    reach private attributes. Powers need a constant exponent, and
+    nested powers may not multiply to more than custom_max_power;
+    other expressions are not limited in the time or memory they take.
+    Returns the code object and the set of names the expression reads
+    (see custom_table_order); both are kept in memory, keyed on the
+    expression text.
+    """
+    if text in custom_code:
+        return custom_code[text]
+
+    import ast
+
+    # Largest product of exponents along nested powers in 'node'
+    def power(node):
+        if not isinstance(node, ast.BinOp) or \
+                not isinstance(node.op, ast.Pow):
+            return max([power(n) for n in ast.iter_child_nodes(node)] + [1])
+
+        try:
+            exponent = ast.literal_eval(node.right)
+        except ValueError:
+            exponent = None
+
+        if not isinstance(exponent, (int, float)):
+            msg = "Powers in custom tables need a constant exponent"
+            raise SyntaxError(msg)
+
+        base = power(node.left)
+        return max(base, abs(exponent) * base)
+
+    tree = ast.parse(text, mode = 'eval')
+    for node in ast.walk(tree):
+        nodetype = node.__class__.__name__
+        if nodetype not in custom_nodes:
+            msg = "'%s' is not allowed in custom tables"
+            raise SyntaxError(msg % nodetype)
+        elif nodetype == 'Name' and node.id.startswith('_'):
+            msg = "Name '%s' is not allowed in custom tables"
+            raise SyntaxError(msg % node.id)
+        elif nodetype == 'Attribute' and node.attr not in custom_attributes:
+            msg = "Attribute '%s' is not allowed in custom tables"
+            raise SyntaxError(msg % node.attr)
+
+    if power(tree) > custom_max_power:
+        msg = "Powers in custom tables may not exceed %d"
+        raise SyntaxError(msg % custom_max_power)
+
+    code  = compile(tree, '<tablefill-python>', 'eval')
+    names = set([node.id for node in ast.walk(tree)
+                 if isinstance(node, ast.Name)])
+    custom_code[text] = code, names
+    return custom_code[text]
+
+
+def custom_table_order(cnames):
+    """
+    Order the custom tables in 'cnames' (tags and the names their
+    expressions read) so that each one comes after the custom tables
+    it uses. Ties are broken by tag so the order is always the same.
+    Returns the order and, if custom tables use each other in a cycle,
+    one such cycle (e.g. ['a', 'b', 'a']); the tables in a cycle, and
+    those that use them, are left out of the order.
+    """
+
+    # A custom table can use an input table with its own tag
+    deps = {}
+    for tag, names in cnames.items():
+        deps[tag] = (set(names) & set(cnames)) - set([tag])
+
+    order = []
+    ready = sorted([tag for tag in deps if not deps[tag]])
+    while ready:
+        tag    = ready.pop(0)
+        order += [tag]
+        for other in sorted(deps):
+            if tag in deps[other]:
+                deps[other].remove(tag)
+                if not deps[other]:
+                    ready += [other]
+
+    cycle = []
+    if len(order) < len(deps):
+        cycle = [min(set(deps) - set(order))]
+        while cycle.count(cycle[-1]) < 2:
+            cycle += [min(deps[cycle[-1]])]
+
+        cycle = cycle[cycle.index(cycle[-1]):]
+
+    return order, cycle
+
+
+custom_code  = {}
+
+# Largest product of exponents along nested powers in a custom table
+custom_max_power = 1024
+
+# Syntax custom tables may use (see compile_custom_table)
+custom_nodes = set(['Expression', 'Name', 'Load', 'Num', 'Str',
+                    'Bytes', 'Constant', 'NameConstant', 'Ellipsis',
+                    'Subscript', 'Index', 'Slice', 'ExtSlice', 'Tuple',
+                    'List', 'Dict', 'Set', 'BinOp', 'UnaryOp', 'BoolOp',
+                    'Compare', 'IfExp', 'Call', 'keyword', 'Attribute',
+                    'Starred',
+                    'Add', 'Sub', 'Mult', 'MatMult', 'Div', 'FloorDiv',
+                    'Mod', 'Pow', 'BitAnd', 'BitOr', 'BitXor', 'Invert',
+                    'UAdd', 'USub', 'Not', 'And', 'Or', 'Eq', 'NotEq',
+                    'Lt', 'LtE', 'Gt', 'GtE', 'In', 'NotIn', 'Is',
+                    'IsNot'])
+
+# numpy functions and array/list methods custom tables may use
+custom_attributes = set(['T', 'A', 'A1', 'shape', 'ndim', 'size', 'abs',
+                         'sum', 'mean', 'std', 'var', 'min', 'max',
+                         'cumsum', 'cumprod', 'prod', 'round', 'around',
+                         'transpose', 'reshape', 'flatten', 'ravel',
+                         'tolist', 'astype', 'diagonal', 'diag', 'copy',
+                         'array', 'asarray', 'matrix', 'asmatrix',
+                         'hstack', 'vstack', 'column_stack',
+                         'concatenate', 'sqrt', 'exp', 'log', 'log10',
+                         'absolute', 'where', 'isnan', 'nan', 'inf',
+                         'nansum', 'nanmean', 'zeros', 'ones', 'full',
+                         'arange', 'dot', 'floor', 'ceil', 'sign',
+                         'maximum', 'minimum', 'argsort', 'sort',
+                         'strip', 'lower', 'upper', 'join', 'split',
+                         'index', 'count'])
+
+custom_builtins = dict((name, getattr(builtins, name))
+                       for name in ['True', 'False', 'None', 'abs', 'all',
+                                    'any', 'bool', 'dict', 'enumerate',
+                                    'float', 'int', 'len', 'list', 'map',
+                                    'max', 'min', 'range', 'reversed',
+                                    'round', 'sorted', 'str', 'sum',
+                                    'tuple', 'zip']
+                       if hasattr(builtins, name))
+
+custom_globals = {'__builtins__': custom_builtins}
+
+
 # ---------------------------------------------------------------------
 # tablefill
 
@@ -256,6 +727,9 @@ def tablefill(silent         = False,
               use_floats     = False,
               ignore_xml     = False,
               xml_tables     = None,
+              tables         = None,
+              cache          = None,
+              incremental    = False,
               **kwargs):
     """Fill LaTeX and LyX template files with external inputs
 
@@ -287,6 +761,16 @@ def tablefill(silent         = False,
         try to print nothing at all
     filetype : str
         auto, lyx, or tex
+    tables : dict
+        Tables already parsed from 'input' with parse_input_tables (so
+        several templates can share them; see tablefill_batch)
+    cache : str
+        Directory where parsed input tables are cached, keyed on the
+        contents of the input files
+    incremental : bool
+        Re-use tables filled in the last run if their template lines
+        and values have not changed (saved in a manifest next to the
+        output), and only write the output if it changed
 
     Output
     ------
@@ -316,7 +800,9 @@ def tablefill(silent         = False,
                                                  numpy_syntax,
                                                  use_floats,
                                                  ignore_xml,
-                                                 xml_tables)
+                                                 xml_tables,
+                                                 cache,
+                                                 incremental)
 
         fill_engine.get_parsed_arguments(kwargs)
         fill_engine.get_file_type()
@@ -325,7 +811,7 @@ def tablefill(silent         = False,
         logmsg  = "Parsing tables in into dictionary:" + linesep + '\t'
         logmsg += (linesep + '\t').join(tolist(fill_engine.input))
         print_verbose(verbose, logmsg)
-        fill_engine.get_parsed_tables()
+        fill_engine.get_parsed_tables(tables)
 
         logmsg  = "Searching for labels in template:" + linesep + '\t'
         logmsg += (linesep + '\t').join(tolist(fill_engine.template))
@@ -338,7 +824,7 @@ def tablefill(silent         = False,
 
         logmsg = "Writing to output file '%s'" % fill_engine.output
         print_verbose(verbose, logmsg)
-        fill_engine.write_to_output(fill_engine.filled_template)
+        fill_engine.write_to_output()
 
         logmsg = "Wrapping up..." + linesep
         print_verbose(verbose, logmsg)
@@ -353,6 +839,153 @@ def tablefill(silent         = False,
         print_silent(silent, exit_msg)
         return exit, exit_msg
 
+
+# ---------------------------------------------------------------------
+# tablefill_batch
+
+def tablefill_batch(manifest  = None,
+                    jobs      = None,
+                    input     = '',
+                    processes = 1,
+                    silent    = False,
+                    **kwargs):
+    """Fill many templates, parsing each set of input files only once
+
+    Description
+    -----------
+
+    Each template is filled by tablefill, but the input tables are read
+    and parsed once per distinct set of input files and shared by all
+    the templates that use them. Custom XML tables are still created
+    for each template, since they are defined in the template.
+
+    Input
+    -----
+
+    manifest : str
+        File with one template per line, as 'TEMPLATE OUTPUT [INPUT ...]'
+        (paths relative to the manifest; lines starting with # are
+        ignored). Templates without INPUT use 'input'.
+    jobs : list
+        Alternatively, a list of dicts with keys 'template', 'output'
+        and (optionally) 'input', as passed to tablefill.
+    input : str
+        Space-separated list of default input files.
+    processes : int
+        Fill templates with a pool of this many processes.
+    **kwargs
+        Options passed to tablefill for every template.
+
+    Output
+    ------
+    results : list
+        (template, exit, exit_msg) for each template, where exit is one
+        of SUCCESS, WARNING, ERROR
+
+    Usage
+    -----
+    results = tablefill_batch(manifest = 'tables.txt',
+                              input    = 'input_file(s)')
+    """
+    jobs = [] if jobs is None else [dict(job) for job in jobs]
+    if manifest is not None:
+        jobs += read_batch_manifest(manifest)
+
+    for job in jobs:
+        job['input'] = job.get('input', input)
+
+    # Parse each distinct set of input files once
+    tables = {}
+    for job in jobs:
+        infiles = tuple(path.abspath(f) for f in job['input'].split())
+        if infiles not in tables:
+            try:
+                cache = kwargs.get('cache', None)
+                tables[infiles] = load_input_tables(infiles, cache)
+            except:
+                tables[infiles] = format_exc()
+
+    # Pool workers get the tables once each, when they start, so this
+    # works whether they are forked or spawned
+    kwargs['silent'] = silent
+    batch = [(job, kwargs) for job in jobs]
+    if processes > 1 and len(batch) > 1:
+        from multiprocessing import Pool
+        pool    = Pool(processes, tablefill_internals_batch_init, (tables,))
+        results = pool.map(tablefill_internals_batch, batch)
+        pool.close()
+        pool.join()
+    else:
+        results = [tablefill_internals_batch(b, tables) for b in batch]
+
+    summary  = [linesep + "Filled %d templates:" % len(results)]
+    summary += ["\t%-7s %s" % (exit, template)
+                for template, exit, exit_msg in results]
+    for status in ['SUCCESS', 'WARNING', 'ERROR']:
+        n = len([r for r in results if r[1] == status])
+        summary += ["%s: %d" % (status, n)]
+
+    print_silent(silent, linesep.join(summary))
+    return results
+
+
+def tablefill_internals_batch(batch, tables = None):
+    """
+    WARNING: Internal function to fill one template in tablefill_batch
+    """
+    job, kwargs = batch
+    tables  = batch_tables if tables is None else tables
+    infiles = tuple(path.abspath(f) for f in job['input'].split())
+    tables  = tables[infiles]
+    if isinstance(tables, basestring):
+        return job['template'], 'ERROR', tables
+
+    exit, exit_msg = tablefill(template = job['template'],
+                               output   = job['output'],
+                               input    = job['input'],
+                               tables   = tables,
+                               **kwargs)
+
+    return job['template'], exit, exit_msg
+
+
+def tablefill_internals_batch_init(tables):
+    """
+    WARNING: Internal function to pass parsed tables to pool workers
+    """
+    global batch_tables
+    batch_tables = tables
+
+
+def read_batch_manifest(manifest):
+    """
+    Read 'TEMPLATE OUTPUT [INPUT ...]' lines from a batch manifest
+    """
+    jobs = []
+    import shlex
+    base = path.dirname(path.abspath(manifest))
+    for line in open(manifest, 'rU').readlines():
+        entries = shlex.split(line, comments = True)
+        if entries == []:
+            continue
+        elif len(entries) < 2:
+            msg = "Manifest line '%s' should be 'TEMPLATE OUTPUT [INPUT ...]'"
+            raise ValueError(msg % line.strip())
+
+        entries = [path.join(base, e) for e in entries]
+        job = {'template': entries[0], 'output': entries[1]}
+        if len(entries) > 2:
+            job['input'] = ' '.join(entries[2:])
+
+        jobs += [job]
+
+    return jobs
+
+
+# Parsed tables in tablefill_batch pool workers
+batch_tables = {}
+
+
 # ---------------------------------------------------------------------
 # tablefill_internals_cliparse
 
@@ -393,6 +1026,7 @@ class tablefill_internals_cliparse:
                             metavar  = 'INPUT',
                             default  = None,
                             help     = "Input files with tables" +
+                            " (.txt, or .npz/.npy with numpy)" +
                             " (default: INPUT_table)",
                             required = False)
         parser.add_argument('-o', '--output',
@@ -475,6 +1109,35 @@ class tablefill_internals_cliparse:
                             default  = None,
                             help     = "Files with custom XML combinations.",
                             required = False),
+        parser.add_argument('--cache',
+                            dest     = 'cache',
+                            type     = str,
+                            nargs    = '?',
+                            metavar  = 'DIR',
+                            const    = '.tablefill_cache',
+                            default  = None,
+                            help     = "Cache parsed inputs in DIR" +
+                                       " (default: .tablefill_cache)," +
+                                       " keeping the %d most recently" %
+                                       cache_max_files + " used files",
+                            required = False)
+        parser.add_argument('--incremental',
+                            dest     = 'incremental',
+                            action   = 'store_true',
+                            help     = "Only re-fill tables that changed",
+                            required = False)
+        parser.add_argument('--batch',
+                            dest     = 'batch',
+                            action   = 'store_true',
+                            help     = "TEMPLATE is a manifest with lines" +
+                                       " 'TEMPLATE OUTPUT [INPUT ...]'",
+                            required = False)
+        parser.add_argument('--processes',
+                            dest     = 'processes',
+                            type     = int,
+                            default  = 1,
+                            help     = "Processes to use with --batch",
+                            required = False)
         parser.add_argument('--verbose',
                             dest     = 'verbose',
                             action   = 'store_true',
@@ -496,6 +1159,10 @@ class tablefill_internals_cliparse:
         missing_args  = []
         missing_args += ['INPUT'] if args.input is None else []
         missing_args += ['OUTPUT'] if args.output is None else []
+        if args.batch:
+            args.input   = [] if args.input is None else args.input
+            missing_args = []
+
         if missing_args != []:
             if not args.force:
                 isare = ' is ' if len(missing_args) == 1 else ' are '
@@ -524,7 +1191,10 @@ class tablefill_internals_cliparse:
         """
         self.template = path.abspath(self.args.template[0])
         self.input    = ' '.join([path.abspath(f) for f in self.args.input])
-        self.output   = path.abspath(self.args.output[0])
+        if self.args.output is None:
+            self.output = None
+        else:
+            self.output = path.abspath(self.args.output[0])
         self.silent   = self.args.silent
         self.verbose  = self.args.verbose and not self.args.silent
         self.stars    = self.args.stars
@@ -534,6 +1204,8 @@ class tablefill_internals_cliparse:
         self.use_floats     = self.args.use_floats
         self.ignore_xml     = self.args.ignore_xml
         self.xml_tables     = self.args.xml_tables
+        self.cache          = self.args.cache
+        self.incremental    = self.args.incremental
         try:
             self.pvals = [float(p) for p in self.args.pvals]
             assert all([(0 < p < 1) for p in self.pvals])
@@ -601,6 +1273,35 @@ class tablefill_internals_cliparse:
                 system(compile_program + linesep)
 
 
+# ---------------------------------------------------------------------
+# tablefill_internals_views
+
+class tablefill_internals_views:
+    """
+    WARNING: Internal class with lazy views of a dictionary of tables.
+
+    Getting a tag applies 'convert' to the corresponding table in
+    'tables' the first time and caches the result; tags can also be
+    set directly. Used as the namespace for custom table expressions.
+    """
+    def __init__(self, tables, convert):
+        self.tables  = tables
+        self.convert = convert
+        self.views   = {}
+
+    def __getitem__(self, tag):
+        if tag not in self.views:
+            self.views[tag] = self.convert(self.tables[tag])
+
+        return self.views[tag]
+
+    def __setitem__(self, tag, view):
+        self.views[tag] = view
+
+    def __contains__(self, tag):
+        return tag in self.views or tag in self.tables
+
+
 # ---------------------------------------------------------------------
 # tablefill_internals_engine
 
@@ -619,7 +1320,9 @@ class tablefill_internals_engine:
                  numpy_syntax   = False,
                  use_floats     = False,
                  ignore_xml     = False,
-                 xml_tables     = None):
+                 xml_tables     = None,
+                 cache          = None,
+                 incremental    = False):
 
         # Get file type
         self.filetype     = filetype.lower()
@@ -652,12 +1355,17 @@ class tablefill_internals_engine:
         starlist.sort(key = lambda p: p[0], reverse = True)
         self.pvals          = [p for (p, s) in starlist]
         self.stars          = [s for (p, s) in starlist]
+        self.thresholds     = sorted(self.pvals)
+        self.star_cache     = {}
+        self.star_cells     = {}
         self.fillc          = fillc
         self.legacy_parsing = legacy_parsing
         self.numpy_syntax   = numpy_syntax
         self.use_floats     = use_floats
         self.ignore_xml     = ignore_xml
         self.xml_tables     = xml_tables
+        self.cache          = cache
+        self.incremental    = incremental
 
     def get_parsed_arguments(self, kwargs):
         """
@@ -763,25 +1471,35 @@ class tablefill_internals_engine:
             self.end   = r'</lyxtabular>'
             self.label = r'name "tab:(.+)"'
 
-    def get_parsed_tables(self):
+        # Compile everything once; the fill loop runs these on every line
+        self.re_tags     = re.compile(self.tags, flags = re.IGNORECASE)
+        self.re_matche   = re.compile(self.matche)
+        self.re_match0   = re.compile(self.match0)
+        self.re_matcha   = re.compile(self.matcha)
+        self.re_matchb   = re.compile(self.matchb)
+        self.re_matchab  = re.compile('(%s)|(%s)' % (self.matcha, self.matchb))
+        self.re_matchc   = re.compile(self.matchc)
+        self.re_matchd   = re.compile(self.matchd)
+        self.re_comments = re.compile(self.comments)
+        self.re_begin    = re.compile(self.begin)
+        self.re_end      = re.compile(self.end)
+        self.re_label    = re.compile(self.label, flags = re.IGNORECASE)
+
+        # Parsed numeric formats of each distinct #\d+# cell
+        self.number_formats = {}
+
+    def get_parsed_tables(self, tables = None):
         """
         Parse table file(s) into a dictionary with tags as keys and
-        lists of table entries as values
+        lists of table entries as values. If 'tables' were already
+        parsed (e.g. by tablefill_batch) they are used instead.
         """
 
         # Read in all the tables
-        read_data  = [open(file, 'rU').readlines() for file in self.input]
-        parse_data = sum(read_data, [])
-
-        ctables = {}
-        for row in parse_data:
-            if re.match(self.tags, row, flags = re.IGNORECASE):
-                tag = re.findall(self.tags, row, flags = re.IGNORECASE)
-                tag = tag[0].lower()
-                ctables[tag] = []
-            else:
-                clean_row_entries = [e.strip() for e in row.split('\t')]
-                ctables[tag] += [clean_row_entries]
+        if tables is None:
+            ctables = load_input_tables(self.input, self.cache)
+        else:
+            ctables = dict(tables)
 
         if self.xml_tables is None and not self.ignore_xml:
             if self.legacy_parsing:
@@ -853,6 +1571,9 @@ class tablefill_internals_engine:
             i += 1
 
         # Prase each custom XMl tag into a dictionary
+        if custom != []:
+            import xml.etree.ElementTree as xml
+
         cdict = {}
         for c in custom:
             chtml    = []
@@ -869,23 +1590,49 @@ class tablefill_internals_engine:
             t = cxml.get('tag')
             cdict[t] = cxml
 
-        # Get temporary string and numeric dictionaries
+        # Get temporary string and numeric dictionaries. The numeric
+        # and numpy versions of each table are only created if a custom
+        # table uses them, and numpy is only imported if one does.
+        for tag, cxml in cdict.items():
+            csyntax  = cxml.get('syntax')
+            usenumpy = self.numpy_syntax and not csyntax == 'python'
+            usenumpy = usenumpy or (csyntax == 'numpy')
+            if usenumpy or 'numpy' in (cxml.text or ''):
+                import_numpy()
+
         strdict = ctables
-        numdict = {}
-        for tag, table in ctables.items():
-            numdict[tag] = nested_convert(table, float)
+        numdict = tablefill_internals_views(ctables, nested_float)
 
         numpy_strdict = {}
         numpy_numdict = {}
         if numpyok:
-            for tag, table in strdict.items():
-                numpy_strdict[tag] = numpy.asmatrix(table)
+            numpy_strdict = tablefill_internals_views(strdict, numpy.asmatrix)
+            numpy_numdict = tablefill_internals_views(numdict, numpy.asmatrix)
+
+        # Compile all the custom tables, then create them using
+        # python/numpy slicing so that custom tables used by other
+        # custom tables are created first
+        ccode  = {}
+        cnames = {}
+        for tag, cxml in cdict.items():
+            try:
+                clean_text = re.subn('\s|' + linesep, '', cxml.text or '')[0]
+                ccode[tag], cnames[tag] = compile_custom_table(clean_text)
+            except Exception as e:
+                warn_custom = "custom 'tab:%s' failed to parse: %s" % (tag, e)
+                print_verbose(self.verbose, '\t' + warn_custom)
 
-            for tag, table in numdict.items():
-                numpy_numdict[tag] = numpy.asmatrix(table)
+        order, cycle = custom_table_order(cnames)
+        if cycle != []:
+            xml_cycle_msg  = "Custom tables use each other in a cycle: "
+            xml_cycle_msg += ' -> '.join(cycle)
+            print_verbose(self.verbose, '\t' + xml_cycle_msg)
+            for tag in sorted(set(cnames) - set(order)):
+                warn_custom = "custom 'tab:%s' failed to parse (cycle)." % tag
+                print_verbose(self.verbose, '\t' + warn_custom)
 
-        # Create all the custom tables using python/numpy slicing
-        for tag, cxml in cdict.items():
+        for tag in order:
+            cxml = cdict[tag]
             print_verbose(self.verbose, "\tcreating custom tab:%s" % (tag))
 
             csyntax = cxml.get('syntax')
@@ -913,8 +1660,7 @@ class tablefill_internals_engine:
                 usedict = numpy_strdict if numpyok and usenumpy else strdict
 
             try:
-                clean_text = re.subn('\s|' + linesep, '', cxml.text)[0]
-                ceval = eval(clean_text, usedict)
+                ceval = eval(ccode[tag], custom_globals, usedict)
                 if numpyok and usenumpy:
                     if usetype in ['float', 'numeric']:
                         numpy_numdict[tag] = ceval
@@ -994,6 +1740,9 @@ class tablefill_internals_engine:
             i += 1
 
         # Put them into a dictionary
+        if custom != []:
+            import xml.etree.ElementTree as xml
+
         cdict = {}
         edict = {}
         for c, e in zip(custom, todo):
@@ -1012,6 +1761,9 @@ class tablefill_internals_engine:
             cdict[t] = cxml
             edict[t] = e
 
+        if cdict != {}:
+            import_numpy()
+
         # Create all the custom tables using python/numpy slicing
         for tag, cxml in cdict.items():
             print_verbose(self.verbose, "\tcreating custom tab:%s" % (tag))
@@ -1038,8 +1790,8 @@ class tablefill_internals_engine:
             if edict[tag] == 'python':
                 inputs  = [l.strip() for l in cxml.get('inputs').split(',')]
                 inputs  = filter(lambda a: a != '', inputs)
-                xmlexec = mktemp()
-                with open(xmlexec, "w+") as tmp:
+                fd, xmlexec = mkstemp(suffix = '.py')
+                with fdopen(fd, 'w') as tmp:
                     tmp.writelines(cxml.text)
 
                 python = {}
@@ -1058,8 +1810,9 @@ class tablefill_internals_engine:
                 except:
                     xml_python_msg = "Custom code for '%s' failed to run."
                     raise Warning('\t' + xml_python_msg % tag)
+                finally:
+                    remove(xmlexec)
 
-                remove(xmlexec)
                 try:
                     table_tag = python[tag]
                 except:
@@ -1122,100 +1875,317 @@ class tablefill_internals_engine:
             - Too many tokens in table and not enough values.
             - Token outside of begin/end table statement.
             - Table label does not match tag in inputs.
+
+        The filled lines are written to a temporary file as they are
+        produced (see write_to_output), so large templates are never
+        held in memory.
+        """
+        self.get_fill_plan()
+        self.get_manifest()
+        self.filled_template = TemporaryFile()
+        self.header_offset   = 0 if self.filetype == 'tex' else None
+        with open(self.template, 'rU') as template:
+            for line in self.fill_lines(template):
+                self.filled_template.write(line)
+                if self.header_offset is None:
+                    if line.startswith('\\begin_body'):
+                        self.header_offset = self.filled_template.tell()
+
+    def get_fill_plan(self):
+        """
+        Compile the template into a fill plan in a single pass, which
+        does not depend on the input tables:
+
+            - self.table_index maps the line where each table starts to
+              the line where it ends and its label ('' if there is no
+              label before the end of the table, and None if the end or
+              the label is never found), so the fill does not need to
+              search ahead.
+            - self.slots maps each line with #(#|\d+,*)# matches to
+              whether it is commented out and the list of placeholders
+              in it (see replace_line).
+
+        If a cache directory was given, the plan is stored there in
+        marshal format keyed on the contents of the template, so that
+        templates are only compiled again when they change (see
+        write_cache).
         """
-        read_template = open(self.template, 'rU').readlines()
-        table_start   = -1
-        table_search  = False
-        table_tag     = ''
-        table_entry   = 0
+        cachefile = None
+        if self.cache is not None:
+            key = sha1((__version__ + str(version_info[:2])).encode())
+            key.update(self.filetype.encode())
+            with open(self.template, 'rb') as fhandle:
+                key.update(sha1(fhandle.read()).digest())
+
+            cachefile = path.join(self.cache, key.hexdigest() + '.plan')
+            cached    = read_cache(cachefile)
+            if cached is not None:
+                self.table_index, self.slots = cached
+                return
+
+        self.table_index = {}
+        self.slots       = {}
+        open_label = []
+        open_end   = []
+        with open(self.template, 'rU') as template:
+            for n, line in enumerate(template):
+                if self.re_matchab.search(line):
+                    commented     = bool(self.re_comments.search(line.strip()))
+                    self.slots[n] = (commented, self.get_line_slots(line))
+
+                if self.re_begin.search(line):
+                    self.table_index[n] = [None, None]
+                    open_label += [n]
+                    open_end   += [n]
+
+                if not open_label and not open_end:
+                    continue
+
+                searchmatch = self.re_label.search(line)
+                searchend   = self.re_end.search(line)
+                if searchend:
+                    for start in open_end:
+                        self.table_index[start][0] = n
+
+                    open_end = []
+
+                if searchmatch or searchend:
+                    if not searchend and searchmatch:
+                        label = searchmatch.group(1)
+                        label = label.strip('{}"').lower()
+                    else:
+                        label = ''
 
-        warn = self.warn_pre
-        for n in range(len(read_template)):
-            line = read_template[n]
-            if not table_search and re.search(self.begin, line):
-                table_search, table_tag = self.search_label(read_template, n)
-                table_start  = n
-                search_msg   = self.get_search_msg(table_search, table_tag, n)
+                    for start in open_label:
+                        self.table_index[start][1] = label
+
+                    open_label = []
+
+        if cachefile is not None:
+            write_cache(cachefile, (self.table_index, self.slots))
+
+    def get_line_slots(self, line):
+        """
+        Find the placeholders in a line. Each is the span it replaces
+        in the line, its kind (stars for #*#, text for ###, or number
+        for #\d+# and friends), the matched text, and the span within
+        it to replace for text placeholders.
+        """
+        slots = []
+        for match0 in self.re_match0.finditer(line):
+            s, e   = match0.span()
+            cell   = match0.group(0)
+            matcha = self.re_matcha.search(cell)
+            matchb = self.re_matchb.search(cell)
+            if matcha and '*' in matcha.groups():
+                slots += [(s, e, 'stars', cell, 0, 0)]
+            elif matcha:
+                a, b   = matcha.span()
+                slots += [(s, e, 'text', cell, a, b)]
+            elif matchb:
+                slots += [(s, e, 'number', cell, 0, 0)]
+
+        return slots
+
+    def fill_lines(self, template):
+        """
+        Generator with the filled lines of 'template' (see
+        get_filled_template), which uses the table index from
+        get_fill_plan to find where tables start and end. In
+        incremental mode, whole tables are filled by fill_block.
+        """
+        table = {'start':  -1,
+                 'end':    -1,
+                 'search': False,
+                 'tag':    '',
+                 'entry':  0}
+
+        lines = enumerate(template)
+        for n, line in lines:
+            if not table['search'] and n in self.table_index:
+                table['search'], table['tag'] = self.search_label(n)
+                table['end']   = self.table_index[n][0]
+                table['start'] = n
+                search_msg = self.get_search_msg(table['search'],
+                                                 table['tag'],
+                                                 n)
                 print_verbose(self.verbose, search_msg)
 
-            if re.search(self.matcha, line) or re.search(self.matchb, line):
-                if re.search(self.comments, line.strip()) and not self.fillc:
-                    warn_incomments  = "Line %d matches #(#|\d+,*)#"
-                    warn_incomments += " but it appears to be commented out."
-                    warn_incomments += " Skipping..."
-                    print_verbose(self.verbose, warn + warn_incomments % n)
-                elif table_search:
-                    table  = self.tables[table_tag]
-                    ntable = len(table)
-                    update = self.replace_line(line, table, table_entry)
-                    read_template[n], table_entry, entry_start = update
-                    if ntable < table_entry:
-                        self.warnings['toolong'] += [str(n)]
-
-                        nstart        = entry_start + 1
-                        nend          = table_entry
-                        aux_toolong   = (n, nstart, nend, table_tag, ntable)
-
-                        warn_toolong  = "Line %d has matches %d-%d for table"
-                        warn_toolong += " %s but the corresponding input"
-                        warn_toolong += " matrix only has %d entries."
-                        warn_toolong += " Skipping..."
-                        warn_toolong  = warn_toolong % aux_toolong
-
-                        print_verbose(self.verbose, warn + warn_toolong)
-                elif table_start == -1:
-                    self.warnings['notable'] += [str(n)]
-
-                    warn_notable  = "Line %d matches #(#|\d+,*)# but"
-                    warn_notable += " is not in begin/end table statements."
-                    warn_notable += " Skipping..."
-
-                    print_verbose(self.verbose, warn + warn_notable % n)
-                elif table_tag == '':
-                    self.warnings['nolabel'] += [str(n)]
-                    warn_nolabel  = "Line %d matches #(#|\d+,*)#"
-                    warn_nolabel += " but couldn't find " + self.label
-                    warn_nolabel += " Skipping..."
-                    print_verbose(self.verbose, warn + warn_nolabel % n)
-
-            if re.search(self.end, line) and table_search:
-                search_msg   = "Table '%s' in line %d ended in line %d."
-                search_msg  += " %d replacements were made." % table_entry
-                search_msg   = search_msg % (table_tag, table_start, n)
-                print_verbose(self.verbose, search_msg + linesep)
-
-                table_start  = -1
-                table_search = False
-                table_tag    = ''
-                table_entry  = 0
-
-        self.filled_template = read_template
-
-    def search_label(self, intext, start):
+                if self.incremental and table['search'] and \
+                        table['end'] is not None:
+                    block = [line]
+                    while n + len(block) <= table['end']:
+                        block += [next(lines)[1]]
+
+                    for fline in self.fill_block(block, table):
+                        yield fline
+
+                    continue
+
+            yield self.fill_line(n, line, table)
+
+    def fill_line(self, n, line, table):
+        """
+        Fill line 'n' of the template. 'table' has the state of the
+        table the line is in (if any) and is updated in place.
         """
-        Search for label in list 'intext' from position 'start' until an
-        \end{table} statement. Returns label value ('' if none is found)
-        and whether it matches a tag in the tables file
+        warn = self.warn_pre
+        if n in self.slots:
+            commented, slots = self.slots[n]
+            if commented and not self.fillc:
+                warn_incomments  = "Line %d matches #(#|\d+,*)#"
+                warn_incomments += " but it appears to be commented out."
+                warn_incomments += " Skipping..."
+                print_verbose(self.verbose, warn + warn_incomments % n)
+            elif table['search']:
+                values = self.tables[table['tag']]
+                ntable = len(values)
+                update = self.replace_line(line,
+                                           slots,
+                                           values,
+                                           table['entry'])
+                line, table['entry'], entry_start = update
+                if ntable < table['entry']:
+                    self.warnings['toolong'] += [str(n)]
+
+                    nstart        = entry_start + 1
+                    nend          = table['entry']
+                    aux_toolong   = (n, nstart, nend, table['tag'], ntable)
+
+                    warn_toolong  = "Line %d has matches %d-%d for table"
+                    warn_toolong += " %s but the corresponding input"
+                    warn_toolong += " matrix only has %d entries."
+                    warn_toolong += " Skipping..."
+                    warn_toolong  = warn_toolong % aux_toolong
+
+                    print_verbose(self.verbose, warn + warn_toolong)
+            elif table['start'] == -1:
+                self.warnings['notable'] += [str(n)]
+
+                warn_notable  = "Line %d matches #(#|\d+,*)# but"
+                warn_notable += " is not in begin/end table statements."
+                warn_notable += " Skipping..."
+
+                print_verbose(self.verbose, warn + warn_notable % n)
+            elif table['tag'] == '':
+                self.warnings['nolabel'] += [str(n)]
+                warn_nolabel  = "Line %d matches #(#|\d+,*)#"
+                warn_nolabel += " but couldn't find " + self.label
+                warn_nolabel += " Skipping..."
+                print_verbose(self.verbose, warn + warn_nolabel % n)
+
+        if table['search'] and n == table['end']:
+            search_msg   = "Table '%s' in line %d ended in line %d."
+            search_msg  += " %d replacements were made." % table['entry']
+            search_msg   = search_msg % (table['tag'], table['start'], n)
+            print_verbose(self.verbose, search_msg + linesep)
+
+            table['start']  = -1
+            table['end']    = -1
+            table['search'] = False
+            table['tag']    = ''
+            table['entry']  = 0
+
+        return line
+
+    def fill_block(self, block, table):
+        """
+        Fill the lines in 'block', which are a whole table. If the
+        manifest from the last run has the same lines filled with the
+        same table values and options, the filled lines and warnings
+        saved there are used instead. Either way they are saved to the
+        new manifest (see write_manifest).
         """
-        N = start
-        searchline  = intext[N]
-        searchmatch = re.search(self.label, searchline,
-                                flags = re.IGNORECASE)
-        searchend   = re.search(self.end, searchline)
-        while not searchmatch and not searchend:
-            N += 1
-            searchline  = intext[N]
-            searchmatch = re.search(self.label, searchline,
-                                    flags = re.IGNORECASE)
-            searchend   = re.search(self.end, searchline)
-
-        if not searchend and searchmatch:
-            label = re.findall(self.label, searchline,
-                               flags = re.IGNORECASE)[0]
-            label = label.strip('{}"').lower()
-            return label in self.tables, label
+        key = sha1(self.get_table_hash(table['tag']))
+        for line in block:
+            key.update(line)
+
+        key   = key.hexdigest()
+        start = table['start']
+        if key in self.manifest:
+            filled, toolong = self.manifest[key]
+            self.warnings['toolong'] += [str(start + k) for k in toolong]
+
+            search_msg  = "Table '%s' in line %d is unchanged since the"
+            search_msg += " last run. Using filled lines in manifest."
+            search_msg  = search_msg % (table['tag'], start)
+            print_verbose(self.verbose, search_msg + linesep)
+
+            table['start']  = -1
+            table['end']    = -1
+            table['search'] = False
+            table['tag']    = ''
+            table['entry']  = 0
         else:
-            return False, ''
+            nwarn   = len(self.warnings['toolong'])
+            filled  = [self.fill_line(start + k, line, table)
+                       for k, line in enumerate(block)]
+            toolong = [int(k) - start
+                       for k in self.warnings['toolong'][nwarn:]]
+
+        self.manifest_filled[key] = (filled, toolong)
+        return filled
+
+    def get_table_hash(self, tag):
+        """
+        Hash of the values of table 'tag' and of the options used to
+        fill them (so the manifest is not used if either changed)
+        """
+        if tag not in self.table_hashes:
+            options = (__version__,
+                       self.filetype,
+                       self.fillc,
+                       self.pvals,
+                       self.stars,
+                       self.tables[tag])
+            self.table_hashes[tag] = sha1(repr(options).encode()).digest()
+
+        return self.table_hashes[tag]
+
+    def get_manifest(self):
+        """
+        Load the manifest saved by the last incremental run for this
+        output, if any (see fill_block)
+        """
+        outdir  = path.dirname(self.output)
+        outname = path.basename(self.output)
+        self.manifest_file   = path.join(outdir, '.%s.manifest' % outname)
+        self.manifest        = {}
+        self.manifest_filled = {}
+        self.table_hashes    = {}
+        if self.incremental and path.isfile(self.manifest_file):
+            try:
+                with open(self.manifest_file, 'rb') as fhandle:
+                    self.manifest = marshal.load(fhandle)
+            except (EOFError, ValueError, TypeError):
+                self.manifest = {}
+
+    def write_manifest(self):
+        """
+        Save the tables filled in this run for the next incremental run
+        """
+        fhandle, tmpfile = open_atomic(self.manifest_file)
+        try:
+            with fhandle:
+                marshal.dump(self.manifest_filled, fhandle)
+
+            rename(tmpfile, self.manifest_file)
+        except:
+            remove(tmpfile)
+            raise
+
+    def search_label(self, start):
+        """
+        Look up the label of the table starting in line 'start' in the
+        table index. Returns label value ('' if none is found) and
+        whether it matches a tag in the tables file
+        """
+        end, label = self.table_index[start]
+        if label is None:
+            msg = "Table in line %d has no matching \\end statement"
+            raise IndexError(msg % start)
+
+        return label in self.tables, label
 
     def get_search_msg(self, search, tag, start):
         warn_nomatch = ''
@@ -1236,81 +2206,98 @@ class tablefill_internals_engine:
 
         return search_msg + warn_nomatch
 
-    def replace_line(self, line, table, tablen):
+    def replace_line(self, line, slots, table, tablen):
         """
-        Replaces all matches of #(#|\d+,*)#. Splits by & because that's
-        how LaTeX delimits tables. Returns how many values it replaced
+        Replaces all matches of #(#|\d+,*)#, using the placeholders
+        found in the line by get_line_slots. The filled line is joined
+        from the text between them and their replacements (which are
+        inserted literally). Returns how many values it replaced
         because LaTeX can have any number of entries per line.
         """
-        i = 0
-        force_stop = False
-        starts = tablen
-        match0 = re.search(self.match0, line)
-        while match0 and not force_stop:
-            s, e = match0.span()
-            cell = line[s:e]
-            matcha = re.search(self.matcha, cell)
-            matchb = re.search(self.matchb, cell)
-
-            if len(table) > tablen:
-                # Replace all pattern A matches (simply replace the text)
-                if matcha:
-                    entry    = re.sub(self.matche, '\\\\\\1', table[tablen])
-                    if '*' in matcha.groups():
-                        cell = self.parse_pval_to_stars(cell, entry)
-                    else:
-                        cell = re.sub(self.matcha, entry, cell, count = 1)
-
-                    line    = re.sub(self.matcha, cell, line, count = 1)
-                    tablen += 1
-
-                # Replace all pattern B matches (round, comma and % format)
-                if matchb:
-                    entry   = re.sub(self.matche, '\\\\\\1', table[tablen])
-                    cell    = self.round_and_format(cell, entry)
-                    line    = re.sub(self.matchb, cell, line, count = 1)
-                    tablen += 1
+        starts  = tablen
+        chunks  = []
+        numbers = []
+        last    = 0
+        for s, e, kind, cell, a, b in slots:
+            if len(table) <= tablen:
+                tablen += 1
+                break
+
+            entry = self.re_matche.sub('\\\\\\1', table[tablen])
+            if kind == 'stars':
+                cell = self.parse_pval_to_stars(cell, entry)
+            elif kind == 'text':
+                cell = cell[:a] + entry + cell[b:]
             else:
-                if matcha or matchb:
-                    starts  = tablen if tablen - starts == i + 1 else starts
-                    tablen += 1
+                # Pattern B matches (round, comma and % format) are all
+                # formatted together once the line has been parsed
+                numbers += [(len(chunks) + 1, cell, entry)]
 
-                force_stop = True
+            chunks += [line[last:s], cell]
+            last    = e
+            tablen += 1
 
-            match0 = re.search(self.match0, line)
-            i += 1
+        if numbers:
+            cells     = [cell for i, cell, entry in numbers]
+            entries   = [entry for i, cell, entry in numbers]
+            formatted = self.round_and_format(cells, entries)
+            for (i, cell, entry), fcell in zip(numbers, formatted):
+                chunks[i] = fcell
 
-        return line, tablen, starts
+        return ''.join(chunks) + line[last:], tablen, starts
 
-    def round_and_format(self, cell, entry):
+    def round_and_format(self, cells, entries):
         """
-        Rounds entry according to the format in cell. Note Decimal's
-        quantize makes the object have the same number of significant
-        digits as the input passed. format(str, ',d') returns str with
-        comma as thousands separator.
+        Rounds entries according to the formats in cells. Cells with
+        the same format are rounded together by format_numbers, and
+        the format of each distinct cell is only parsed once.
         """
-        precision, comma = re.findall(self.matchb, cell)[0]
-        precision = int(precision)
-        roundas   = 0 if precision == 0 else pow(10, -precision)
-        roundas   = Decimal(str(roundas))
-        dentry    = 100 * Decimal(entry) if '%' in comma else Decimal(entry)
-        dentry    = abs(dentry) if re.search(self.matchd, cell) else dentry
-        rounded   = str(dentry.quantize(roundas, rounding = ROUND_HALF_UP))
-        if ',' in comma:
-            integer_part, decimal_part = re.findall(self.matchc, rounded)[0]
-            neg      = '-' if re.match('^-0', integer_part) else ''
-            rounded  = neg + compat_format(int(integer_part)) + decimal_part
-        return re.sub(self.matchb, rounded, cell, count = 1)
+        groups = {}
+        for k, (cell, entry) in enumerate(zip(cells, entries)):
+            if cell not in self.number_formats:
+                matchb    = self.re_matchb.search(cell)
+                precision, comma = matchb.groups()
+                spec      = (int(precision),
+                             '%' in comma,
+                             bool(self.re_matchd.search(cell)),
+                             ',' in comma)
+                self.number_formats[cell] = spec, matchb.span()
+
+            spec, span = self.number_formats[cell]
+            groups.setdefault(spec, []).append(k)
+
+        formatted = list(cells)
+        for spec, group in groups.items():
+            rounded = format_numbers([entries[k] for k in group], *spec)
+            for k, r in zip(group, rounded):
+                a, b = self.number_formats[cells[k]][1]
+                formatted[k] = cells[k][:a] + r + cells[k][b:]
+
+        return formatted
 
     def parse_pval_to_stars(self, cell, entry):
         """
         Parse a p-value to significance symbols. The default is to
         parse 0.1, 0.05, 0.01 to *, **, ***, but the user can specify
         arbitrary thresholds and symbols.
+
+        The number of thresholds above the p-value is found by binary
+        search, and both the stars for each distinct entry and the
+        filled cell for each distinct cell and stars are cached, since
+        the same p-values tend to repeat across tables.
         """
-        pos  = sum([float(entry) < p for p in self.pvals]) - 1
-        star = '' if pos < 0 else self.stars[pos]
-        return re.sub(self.matcha, star, cell, count = 1)
+        if entry not in self.star_cache:
+            above = len(self.thresholds)
+            above = above - bisect_right(self.thresholds, float(entry))
+            star  = '' if above == 0 else self.stars[above - 1]
+            self.star_cache[entry] = star
+
+        star = self.star_cache[entry]
+        if (cell, star) not in self.star_cells:
+            filled = self.re_matcha.sub(star, cell, count = 1)
+            self.star_cells[(cell, star)] = filled
+
+        return self.star_cells[(cell, star)]
 
     def get_notification_message(self):
         """
@@ -1320,7 +2307,6 @@ class tablefill_internals_engine:
             - #(#|\d+,*)# is on a table environment with no label
             - A tabular environment's label has no match in tables.txt
         """
-        n   = 0
         if self.filetype == 'tex':
             head  = 3 * [72 * '%' + linesep]
             tail  = head
@@ -1334,9 +2320,8 @@ class tablefill_internals_engine:
             head += ["status open" + linesep + linesep]
             tail  = ["\\end_inset" + linesep]
             tail += ["\\end_layout" + linesep]
-            while not self.filled_template[n].startswith('\\begin_body'):
-                n += 1
-            n += 1
+            if self.header_offset is None:
+                raise IndexError("No \\begin_body in LyX template")
 
         for key in self.warnings.keys():
             self.warnings[key] = ', '.join(self.warnings[key])
@@ -1385,12 +2370,52 @@ class tablefill_internals_engine:
             msg += ["DO NOT EDIT THIS FILE DIRECTLY."]
 
         msg = [pre + m + after for m in msg]
-        self.filled_template[n:n] = head + msg + tail
+        self.notification = head + msg + tail
+
+    def write_to_output(self):
+        """
+        Writes the filled template with the notification message to a
+        temporary file next to the output, which is then renamed to the
+        output so it is never left half-written. If the output is a
+        symbolic link, the file it points to is replaced instead.
+        """
+        filled = self.filled_template
+        output = path.realpath(self.output)
+        try:
+            outfile, tmpfile = open_atomic(output)
+
+            # We only ever remove our own mkstemp file, so this is safe
+            # even if another process writes the same output
+            try:
+                filled.seek(0)
+                with outfile:
+                    remaining = self.header_offset
+                    while remaining > 0:
+                        chunk = filled.read(min(remaining, 64 * 1024))
+                        outfile.write(chunk)
+                        remaining -= len(chunk)
+
+                    outfile.write(''.join(self.notification))
+                    copyfileobj(filled, outfile)
+
+                # Leave the output alone if it did not change, so
+                # programs that look at its modification time do not
+                # run again
+                unchanged = self.incremental and path.isfile(output)
+                unchanged = unchanged and filecmp.cmp(tmpfile, output, False)
+                if not unchanged:
+                    rename(tmpfile, output)
+            except:
+                remove(tmpfile)
+                raise
+        finally:
+            filled.close()
+
+        if unchanged:
+            remove(tmpfile)
 
-    def write_to_output(self, text):
-        outfile = open(self.output, 'wb')
-        outfile.write(''.join(text))
-        outfile.close()
+        if self.incremental:
+            self.write_manifest()
 
     def get_exit_message(self):
         if self.warning:
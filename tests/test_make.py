@@ -0,0 +1,583 @@
+# -*- coding: utf-8 -*-
+# Run with: python -m unittest discover -s tests
+
+from os import path, unlink, utime, environ, listdir, mkdir
+from subprocess import Popen, PIPE, STDOUT
+from tempfile import mkdtemp
+from shutil import rmtree
+from time import sleep, time
+import unittest
+import signal
+import json
+import sys
+
+root = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from make import MakeDatabase, MakeScheduler, MakeProfile  # noqa
+from make import AppendLogger, run_command, run_python_worker  # noqa
+import make  # noqa
+
+
+makefile = """import sys
+sys.path.insert(0, {0!r})
+from make import MakefileTodo
+todo = MakefileTodo()
+{1}
+"""
+
+
+class MakeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def write(self, fname, text):
+        with open(path.join(self.tmpdir, fname), 'w') as fhandle:
+            fhandle.write(text)
+
+    def read(self, fname):
+        with open(path.join(self.tmpdir, fname), 'r') as fhandle:
+            return fhandle.read()
+
+    def start(self, body, *args):
+        """Start make.py on a target with Makefile.py 'body'; there is
+        no log unless '--logfile' is in 'args'"""
+        self.write('Makefile.py', makefile.format(root, body))
+        command = [sys.executable, path.join(root, 'make.py'),
+                   '-t', self.tmpdir] + list(args)
+        if '--logfile' not in args:
+            command += ['--nolog']
+
+        return Popen(command, stdout = PIPE, stderr = STDOUT,
+                     universal_newlines = True)
+
+    def make(self, body, *args):
+        """Run make.py as in start; returns exit status and output"""
+        proc   = self.start(body, *args)
+        output = proc.communicate()[0]
+        return proc.returncode, output
+
+    def wait(self, test, seconds = 10):
+        """Wait until test() is true; returns whether it was in time"""
+        end = time() + seconds
+        while not test():
+            if time() > end:
+                return False
+
+            sleep(0.05)
+
+        return True
+
+    def exists(self, fname):
+        return path.exists(path.join(self.tmpdir, fname))
+
+
+class TestBuildDatabase(MakeTestCase):
+
+    def setUp(self):
+        MakeTestCase.setUp(self)
+        self.db      = MakeDatabase(path.join(self.tmpdir, 'db.json'),
+                                    self.tmpdir)
+        self.inputs  = [path.join(self.tmpdir, 'in.txt')]
+        self.outputs = [path.join(self.tmpdir, 'out.txt')]
+        self.write('in.txt', 'a')
+        self.write('out.txt', 'b')
+
+    def record(self, torun = ['run']):
+        self.db.record('step', torun,
+                       self.db.state(self.inputs),
+                       self.db.state(self.outputs))
+
+    def uptodate(self, torun = ['run']):
+        state = self.db.state(self.inputs)
+        return self.db.uptodate('step', torun, state, self.outputs)
+
+    def test_unchanged(self):
+        self.assertFalse(self.uptodate())
+        self.record()
+        self.assertTrue(self.uptodate())
+
+    def test_reloaded(self):
+        self.record()
+        self.db = MakeDatabase(self.db.dbfile, self.tmpdir)
+        self.assertTrue(self.uptodate())
+
+    def test_changed_input(self):
+        self.record()
+        self.write('in.txt', 'changed')
+        self.assertFalse(self.uptodate())
+
+    def test_changed_output(self):
+        self.record()
+        self.write('out.txt', 'changed')
+        self.assertFalse(self.uptodate())
+
+    def test_missing_output(self):
+        self.record()
+        unlink(self.outputs[0])
+        self.assertFalse(self.uptodate())
+
+    def test_changed_command(self):
+        self.record()
+        self.assertFalse(self.uptodate(['other']))
+
+    def test_forget(self):
+        self.record()
+        self.db.forget('step')
+        self.assertFalse(self.uptodate())
+
+
+class TestLoopRun(MakeTestCase):
+
+    steps = """todo.default.builddb = '.makedb.json'
+todo.add_run('step.py', rules = 'python',
+             inputs = 'in.txt', outputs = 'out.txt')"""
+
+    def setUp(self):
+        MakeTestCase.setUp(self)
+        self.write('in.txt', 'a')
+        self.write('step.py', "with open('out.txt', 'a') as f:\n"
+                              "    f.write('x')\n")
+
+    def test_skip_uptodate(self):
+        status, output = self.make(self.steps)
+        self.assertEqual(status, 0, output)
+        status, output = self.make(self.steps)
+        self.assertEqual(status, 0, output)
+        self.assertIn("'step.py' is up to date", output)
+        self.assertEqual(self.read('out.txt'), 'x')
+
+    def test_rerun_on_change(self):
+        self.make(self.steps)
+        self.write('in.txt', 'b')
+        status, output = self.make(self.steps)
+        self.assertEqual(status, 0, output)
+        self.assertEqual(self.read('out.txt'), 'xx')
+
+    def test_no_builddb(self):
+        # The build database and the timing history are opt-in
+        steps = self.steps.split("\n", 1)[1]
+        for i in range(2):
+            status, output = self.make(steps)
+            self.assertEqual(status, 0, output)
+
+        self.assertEqual(self.read('out.txt'), 'xx')
+        self.assertFalse(self.exists('.makedb.json'))
+        self.assertFalse(self.exists('.makehistory.jsonl'))
+
+
+class TestAppendLogger(MakeTestCase):
+
+    def append(self, maxsize):
+        with open(path.join(self.tmpdir, 'make.log'), 'w') as loghandle:
+            logger = AppendLogger(loghandle, maxsize = maxsize)
+            logger.append('prog.log', 'prog', self.tmpdir)
+
+        with open(path.join(self.tmpdir, 'make.log'), 'rb') as fhandle:
+            return fhandle.read().decode('utf-8')
+
+    def setUp(self):
+        MakeTestCase.setUp(self)
+        self.lines = [u'line {0} \u00e9\u00e8\u20ac'.format(i)
+                      for i in range(1000)]
+        with open(path.join(self.tmpdir, 'prog.log'), 'wb') as fhandle:
+            fhandle.write(u'\n'.join(self.lines).encode('utf-8'))
+
+    def test_whole(self):
+        log = self.append(None)
+        self.assertIn(u'\n'.join(self.lines), log)
+        self.assertIn('Log file: prog.log', log)
+
+    def test_tail(self):
+        # Cut points fall inside multibyte characters for some sizes
+        for maxsize in [100, 101, 102, 103]:
+            log = self.append(maxsize)
+            self.assertNotIn(self.lines[0], log)
+            self.assertIn(self.lines[-1], log)
+            self.assertIn('not shown', log)
+
+
+class TestScheduler(unittest.TestCase):
+
+    def add(self, scheduler, key, inputs, outputs, declare = True):
+        inputs  = ['/t/' + f for f in inputs]
+        outputs = ['/t/' + f for f in outputs]
+        deps    = scheduler.depends(inputs, outputs, declare)
+        scheduler.add(key, inputs, outputs, declare, key)
+        self.assertEqual(deps, scheduler.deps[key])
+        return deps
+
+    def test_dependencies(self):
+        scheduler = MakeScheduler(jobs = 2)
+        self.assertEqual(self.add(scheduler, 'a', ['in'], ['x']), [])
+        self.assertEqual(self.add(scheduler, 'b', ['in'], ['y']), [])
+        self.assertEqual(self.add(scheduler, 'c', ['x'], ['z']), ['a'])
+        self.assertEqual(self.add(scheduler, 'd', [], ['in']), ['a', 'b'])
+        self.assertEqual(self.add(scheduler, 'e', ['dir/f'], []), [])
+        self.assertEqual(self.add(scheduler, 'f', [], ['dir']), ['e'])
+
+    def test_undeclared(self):
+        scheduler = MakeScheduler(jobs = 2)
+        self.add(scheduler, 'a', ['in'], ['x'])
+        self.assertEqual(self.add(scheduler, 'b', [], [], False), ['a'])
+        self.assertEqual(self.add(scheduler, 'c', ['q'], ['r']), ['b'])
+
+    def test_run_order(self):
+        scheduler = MakeScheduler(jobs = 3)
+        done = []
+        self.add(scheduler, 'a', [], ['x'])
+        self.add(scheduler, 'b', ['x'], ['y'])
+        self.add(scheduler, 'c', ['y'], ['z'])
+        scheduler.run(lambda key: done.append(key))
+        self.assertEqual(done, ['a', 'b', 'c'])
+
+
+class TestProfile(MakeTestCase):
+
+    def test_report(self):
+        profile = MakeProfile(path.join(self.tmpdir, 'hist.jsonl'))
+        profile.add('run', 'both', 0, 2, cpu = 1.5, maxrss = 2048)
+        profile.add('run', 'cpu', 0, 3, cpu = 1.0)
+        profile.add('run', 'none', 0, 1)
+        report = '\n'.join(profile.report())
+        self.assertIn('both (CPU 1.5s, 2 MB)', report)
+        self.assertIn('cpu (CPU 1.0s)\n', report)
+        self.assertIn('none\n', report)
+        self.assertEqual(report.count('('), report.count(')'))
+
+
+    def test_deps(self):
+        # Each block waits for the step that finished last in the one
+        # before; steps without declared files for the step before them
+        profile = MakeProfile(path.join(self.tmpdir, 'hist.jsonl'))
+        profile.add('run', 'a', 0, 2)
+        profile.add('run', 'b', 0, 1)
+        profile.block()
+        profile.add('run', 'c', 2, 3, ['x'])
+        profile.block()
+        profile.add('run', 'd', 3, 4)
+        steps = list(profile.load().values())[0]
+        self.assertEqual(steps['a']['deps'], [])
+        self.assertEqual(sorted(steps['c']['deps']), ['b', 'x'])
+        self.assertEqual(steps['d']['deps'], ['c'])
+
+    def test_undeclared_steps(self):
+        self.write('step.sh', 'true\n')
+        steps  = "todo.default.history = '.makehistory.jsonl'\n"
+        steps += "for i in range(4):\n"
+        steps += "    todo.add_run('step.sh', executable = 'sh')\n"
+        status, output = self.make(steps)
+        self.assertEqual(status, 0, output)
+        with open(path.join(self.tmpdir, '.makehistory.jsonl')) as hist:
+            deps = [r['deps'] for r in map(json.loads, hist)]
+
+        names = ['step.sh'] + ['step.sh ({0})'.format(i) for i in [1, 2]]
+        self.assertEqual(deps, [[]] + [[name] for name in names])
+
+
+class TestTablefill(MakeTestCase):
+
+    template = "\\begin{table}\n\\label{tab:t}\n#1#\n\\end{table}\n"
+
+    def setUp(self):
+        MakeTestCase.setUp(self)
+        self.write('template.tex', self.template)
+        self.write('table.txt', '<tab:t>\n1.24\n')
+
+    def fill(self, table = 'table.txt'):
+        status = make.run_tablefill('template.tex', table, 'out.tex',
+                                    cwd = self.tmpdir, silent = True)
+        self.assertEqual(status, 0)
+        return self.read('out.tex').splitlines()[-2]
+
+    def test_rule(self):
+        status, output = self.make("""todo.add_run(
+    'template.tex', rules = 'tablefill',
+    rules_kwargs = {'input': 'table.txt', 'output': 'out.tex'})""",
+                                   '--logfile', path.join(self.tmpdir, 'log'))
+        self.assertEqual(status, 0, output)
+        self.assertEqual(self.read('out.tex').splitlines()[-2], '1.2')
+        self.assertNotIn('Could not attach', output)
+
+    def test_relative_paths(self):
+        self.write('custom.xml', "<tablefill-python tag='double' "
+                                 "syntax='python'>\n"
+                                 "[float(t[0][0]) * 2]\n"
+                                 "</tablefill-python>\n")
+        self.write('template.tex', self.template.replace('tab:t',
+                                                         'tab:double'))
+        status = make.run_tablefill('template.tex', 'table.txt', 'out.tex',
+                                    cwd        = self.tmpdir,
+                                    cache      = 'cache',
+                                    xml_tables = 'custom.xml',
+                                    silent     = True)
+        self.assertEqual(status, 0)
+        self.assertEqual(self.read('out.tex').splitlines()[-2], '2.5')
+        self.assertTrue(path.isdir(path.join(self.tmpdir, 'cache')))
+
+    def test_same_mtime_and_size(self):
+        table = path.join(self.tmpdir, 'table.txt')
+        utime(table, (1000000000, 1000000000))
+        self.assertEqual(self.fill(), '1.2')
+        self.write('table.txt', '<tab:t>\n7.76\n')
+        utime(table, (1000000000, 1000000000))
+        self.assertEqual(self.fill(), '7.8')
+
+    def test_bounded(self):
+        max_tables = make.tablefill_max_tables
+        make.tablefill_max_tables = 2
+        try:
+            for i in range(4):
+                self.write('table%d.txt' % i, '<tab:t>\n%d.5\n' % i)
+                self.assertEqual(self.fill('table%d.txt' % i), '%d.5' % i)
+                self.assertLessEqual(len(make.tablefill_tables), 2)
+        finally:
+            make.tablefill_max_tables = max_tables
+
+
+# Runs the lines of a master do-file written by run_stata_session; the
+# do-files it runs can only 'sleep' (seconds) or fail with 'error'
+fakestata = """import re, sys, time
+rc, out = 0, []
+dofile  = sys.argv[-1].strip('"')
+for line in open(dofile).read().splitlines():
+    line = line.replace("`make_rc'", str(rc))
+    out += ['. ' + line]
+    if line.startswith('display'):
+        out += [line.split('"')[1] + time.strftime('%d %b %Y %H:%M:%S')]
+    elif line.startswith('capture'):
+        for cmd in open(line.split('"')[1]).read().split():
+            if cmd == 'error':
+                rc = 198
+            else:
+                time.sleep(float(cmd))
+    elif line.startswith('if') and rc != 0:
+        break
+
+open(re.sub(r'\\.do$', '.log', dofile), 'w').write('\\n'.join(out))
+"""
+
+
+class TestStataSession(MakeTestCase):
+
+    steps = """todo.default.history = '.makehistory.jsonl'
+todo.rules['stata']['executable'] = {0!r}
+todo.add_run('a.do', rules = 'stata')
+todo.add_run('b.do', rules = 'stata')
+todo.add_run('c.do', rules = 'stata')"""
+
+    def setUp(self):
+        MakeTestCase.setUp(self)
+        self.write('fakestata.py', fakestata)
+        self.write('a.do', '1.1')
+        self.write('b.do', '0')
+        self.write('c.do', '0')
+        self.steps = self.steps.format(' '.join([
+            sys.executable, path.join(self.tmpdir, 'fakestata.py')]))
+
+    def history(self):
+        with open(path.join(self.tmpdir, '.makehistory.jsonl')) as hist:
+            return dict((r['name'], r) for r in map(json.loads, hist))
+
+    def test_steps_timed(self):
+        status, output = self.make(self.steps, '--stata-session')
+        self.assertEqual(status, 0, output)
+        history = self.history()
+        self.assertEqual(sorted(history.keys()), ['a.do', 'b.do', 'c.do'])
+        self.assertGreaterEqual(history['a.do']['wall'], 1)
+        self.assertLess(history['b.do']['wall'], 1)
+        self.assertEqual(history['b.do']['deps'], ['a.do'])
+        self.assertEqual(history['c.do']['deps'], ['b.do'])
+        for name in ['a.do', 'b.do', 'c.do']:
+            self.assertEqual(history[name]['status'], 0)
+
+    def test_error(self):
+        self.write('b.do', 'error')
+        status, output = self.make(self.steps, '--stata-session')
+        self.assertNotEqual(status, 0)
+        history = self.history()
+        self.assertEqual(sorted(history.keys()), ['a.do', 'b.do'])
+        self.assertEqual(history['a.do']['status'], 0)
+        self.assertEqual(history['b.do']['status'], 198)
+
+
+class TestPythonWorker(MakeTestCase):
+
+    script = """import os, sys
+values = sys.argv[1:] + [os.environ.get('MAKE_TEST_VALUE', '')]
+if sys.version_info[0] >= 3:
+    values = [v.encode('utf-8') for v in values]
+
+with open('out.txt', 'wb') as f:
+    f.write(b'|'.join(values))
+"""
+
+    def setUp(self):
+        MakeTestCase.setUp(self)
+        self.write('script.py', self.script)
+
+    def tearDown(self):
+        make.stop_python_workers()
+        MakeTestCase.tearDown(self)
+
+    def run_script(self, args = ''):
+        result = run_python_worker('script.py', args, sys.executable, [],
+                                   cwd = self.tmpdir)
+        self.assertEqual(result['status'], 0)
+        with open(path.join(self.tmpdir, 'out.txt'), 'rb') as fhandle:
+            return fhandle.read()
+
+    def test_argv(self):
+        arg = u'caf\xe9'
+        if sys.version_info[0] < 3:
+            arg = arg.encode('utf-8')
+
+        self.assertEqual(self.run_script('a "b c" ' + arg),
+                         u'a|b c|caf\xe9|'.encode('utf-8'))
+
+    def test_status(self):
+        for script, status in [('import sys; sys.exit(3)', 3),
+                               ('raise ValueError("boom")', 1)]:
+            self.write('status.py', script)
+            result = run_python_worker('status.py', '', sys.executable, [],
+                                       cwd = self.tmpdir)
+            self.assertEqual(result['status'], status)
+
+    def test_environment(self):
+        try:
+            environ['MAKE_TEST_VALUE'] = 'one'
+            self.assertEqual(self.run_script(), b'one')
+            environ['MAKE_TEST_VALUE'] = 'two'
+            self.assertEqual(self.run_script(), b'two')
+        finally:
+            del environ['MAKE_TEST_VALUE']
+
+        self.assertEqual(self.run_script(), b'')
+
+    def test_stdin(self):
+        self.write('stdin.py', "import sys\n"
+                               "with open('stdin.txt', 'w') as f:\n"
+                               "    f.write(sys.stdin.read())\n")
+        code = ("import sys\n"
+                "sys.path.insert(0, {0!r})\n"
+                "from make import run_python_worker\n"
+                "result = run_python_worker('stdin.py', '', sys.executable,"
+                " [], cwd = {1!r})\n"
+                "sys.exit(result['status'])").format(root, self.tmpdir)
+        proc = Popen([sys.executable, '-c', code], stdin = PIPE)
+        proc.communicate(b'hello')
+        self.assertEqual(proc.returncode, 0)
+        self.assertEqual(self.read('stdin.txt'), 'hello')
+
+
+class TestInterrupt(MakeTestCase):
+
+    # Steps write when they start and, after two seconds, when they end
+    step = "touch {0}.started; sleep 2; touch {0}.done\n"
+
+    def setUp(self):
+        MakeTestCase.setUp(self)
+        for name in ['a', 'b', 'c']:
+            self.write(name + '.sh', self.step.format(name))
+
+    def interrupt(self, proc, signum, started):
+        """Send 'signum' to make.py once 'started' steps have started;
+        check that it and the steps stop"""
+        self.assertTrue(self.wait(lambda: all([
+            self.exists(name + '.started') for name in started])))
+        proc.send_signal(signum)
+        self.assertTrue(self.wait(lambda: proc.poll() is not None, 1.5))
+        proc.communicate()
+        self.assertNotEqual(proc.returncode, 0)
+
+        sleep(2.5)
+        for name in ['a', 'b', 'c']:
+            self.assertFalse(self.exists(name + '.done'))
+
+    def test_ctrl_c(self):
+        proc = self.start("todo.add_run('a.sh', executable = 'sh')")
+        self.interrupt(proc, signal.SIGINT, ['a'])
+
+    def test_sigterm(self):
+        proc = self.start("todo.add_run('a.sh', executable = 'sh')")
+        self.interrupt(proc, signal.SIGTERM, ['a'])
+
+    def test_python_worker(self):
+        self.write('a.py', "import time\n"
+                           "open('a.started', 'w').close()\n"
+                           "time.sleep(2)\n"
+                           "open('a.done', 'w').close()\n")
+        proc = self.start("todo.rules['python']['executable'] = {0!r}\n"
+                          "todo.rules['python']['workers'] = True\n"
+                          "todo.add_run('a.py', rules = 'python')"
+                          .format(sys.executable))
+        self.interrupt(proc, signal.SIGINT, ['a'])
+
+    def test_jobs(self):
+        # 'a' and 'b' run at the same time; 'c' waits for a free job
+        steps = "\n".join(["todo.add_run('{0}.sh', executable = 'sh',"
+                            " inputs = [], outputs = '{0}.done')".format(f)
+                            for f in ['a', 'b', 'c']])
+        proc  = self.start(steps, '-j', '2')
+        self.interrupt(proc, signal.SIGINT, ['a', 'b'])
+        self.assertFalse(self.exists('c.started'))
+
+
+class TestTargetJobs(MakeTestCase):
+
+    def test_nolog(self):
+        targets = [path.join(self.tmpdir, name) for name in ['t1', 't2']]
+        for target in targets:
+            mkdir(target)
+            with open(path.join(target, 'Makefile.py'), 'w') as fhandle:
+                fhandle.write(makefile.format(
+                    root, "todo.add_run('echo.sh', executable = 'sh')"))
+
+            with open(path.join(target, 'echo.sh'), 'w') as fhandle:
+                fhandle.write("echo hello from $(basename $(pwd))\n")
+
+        command = [sys.executable, path.join(root, 'make.py'), '-t'] + \
+            targets + ['--target-jobs', '2', '--nolog']
+        proc    = Popen(command, stdout = PIPE, stderr = STDOUT,
+                        cwd = self.tmpdir, universal_newlines = True)
+        output  = proc.communicate()[0]
+        self.assertEqual(proc.returncode, 0, output)
+        self.assertIn('hello from t1', output)
+        self.assertIn('hello from t2', output)
+        for folder in [self.tmpdir] + targets:
+            self.assertEqual([f for f in listdir(folder)
+                              if f.endswith('.log')], [])
+
+
+class TestRunCommand(unittest.TestCase):
+
+    def test_status(self):
+        result = run_command('exit 3')
+        self.assertEqual(result['status'], 3)
+        self.assertFalse(result['timeout'])
+
+    def test_cwd(self):
+        tmpdir = mkdtemp()
+        try:
+            result = run_command('test "$(pwd -P)" = "{0}"'.format(
+                path.realpath(tmpdir)), cwd = tmpdir)
+        finally:
+            rmtree(tmpdir)
+
+        self.assertEqual(result['status'], 0)
+
+    def test_timeout_stops_process_group(self):
+        # The background sleep is in the command's process group, so it
+        # is stopped too, and the pipe closes
+        result = run_command('sleep 30 & sleep 30', timeout = 0.5)
+        self.assertTrue(result['timeout'])
+        self.assertLess(result['wall'], 10)
+        self.assertNotEqual(result['status'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,655 @@
+# -*- coding: utf-8 -*-
+# Run with: python -m unittest discover -s tests
+
+from os import path, listdir, stat, utime, remove, symlink, mkdir, chmod
+from tempfile import mkdtemp
+from shutil import rmtree
+from decimal import Decimal, ROUND_HALF_UP
+import itertools
+import unittest
+import sys
+import re
+
+root = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import tablefill  # noqa
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+table = """<tab:test>
+1.2345\t2.5\t0.03
+1234567.891\t-0.5\tfoo
+<tab:other>
+0.2\t0.001
+"""
+
+template = r"""\documentclass{article}
+\begin{document}
+\begin{table}
+\label{tab:test}
+#2# & #1,# & #*# \\
+#0,# & ### & ### \\
+\end{table}
+\begin{table}
+\label{tab:other}
+#2# #*#
+\end{table}
+\end{document}
+"""
+
+filled = r"""\documentclass{article}
+\begin{document}
+\begin{table}
+\label{tab:test}
+1.23 & 2.5 & ** \\
+1,234,568 & -0.5 & foo \\
+\end{table}
+\begin{table}
+\label{tab:other}
+0.20 ***
+\end{table}
+\end{document}
+"""
+
+
+class TablefillTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.write('table.txt', table)
+        self.write('template.tex', template)
+
+    def tearDown(self):
+        rmtree(self.tmpdir)
+
+    def path(self, fname):
+        return path.join(self.tmpdir, fname)
+
+    def write(self, fname, text):
+        with open(self.path(fname), 'w') as fhandle:
+            fhandle.write(text)
+
+    def read(self, fname):
+        with open(self.path(fname), 'r') as fhandle:
+            return fhandle.read()
+
+    def fill(self, text = None, output = 'output.tex', **kwargs):
+        """Fill 'text' (or template.tex); returns exit, message, output"""
+        if text is not None:
+            self.write('template.tex', text)
+
+        kwargs['input']    = kwargs.get('input', self.path('table.txt'))
+        kwargs['template'] = self.path('template.tex')
+        kwargs['output']   = self.path(output)
+        kwargs['silent']   = True
+        exit, exit_msg = tablefill.tablefill(**kwargs)
+        if path.isfile(self.path(output)):
+            return exit, exit_msg, self.read(output)
+        else:
+            return exit, exit_msg, None
+
+    def body(self, output):
+        """Filled lines, without the header tablefill adds"""
+        return output[output.index('\\documentclass'):]
+
+
+class TestFill(TablefillTestCase):
+
+    def test_fill(self):
+        exit, exit_msg, output = self.fill()
+        self.assertEqual(exit, 'SUCCESS', exit_msg)
+        self.assertEqual(self.body(output), filled)
+
+    def test_permissions(self):
+        self.fill()
+        mode = stat(self.path('output.tex')).st_mode & 0o777
+        self.assertEqual(mode, 0o666 & ~tablefill.file_umask)
+
+        chmod(self.path('output.tex'), 0o640)
+        exit, exit_msg, output = self.fill()
+        self.assertEqual(exit, 'SUCCESS', exit_msg)
+        self.assertEqual(stat(self.path('output.tex')).st_mode & 0o777, 0o640)
+        self.assertEqual([f for f in listdir(self.tmpdir)
+                          if f.startswith('.tmp')], [])
+
+
+# How tablefill rounded each #\d+# cell before format_numbers
+def decimal_format(entry, precision, percent, absolute, comma):
+    roundas = 0 if precision == 0 else pow(10, -precision)
+    roundas = Decimal(str(roundas))
+    dentry  = 100 * Decimal(entry) if percent else Decimal(entry)
+    dentry  = abs(dentry) if absolute else dentry
+    rounded = str(dentry.quantize(roundas, rounding = ROUND_HALF_UP))
+    if comma:
+        matchc  = re.search(r'(-?\d+)(\.?\d*)', rounded)
+        integer_part, decimal_part = matchc.groups()
+        neg     = '-' if integer_part.startswith('-0') else ''
+        rounded = neg + tablefill.compat_format(int(integer_part))
+        rounded = rounded + decimal_part
+
+    return rounded
+
+
+class TestFormatNumbers(unittest.TestCase):
+
+    entries = ['0', '-0', '+0', '0.0', '-0.00', '5', '-5', '95',
+               '9.995', '-9.995', '9.9949', '0.995', '0.005', '-0.005',
+               '0.0049', '999.5', '-999.5', '999999.995', '1234567.891',
+               '-1234567.891', '0.125', '2.675', '1.005', '12.', '.5',
+               '-.5', '+3.14159', ' 7.25 ', '99999.99999', '0.0000005',
+               '-0.0000004', '1e3', '-1.5e-2', '1E+2', '2.5E-1',
+               '123456789012345678901234.5']
+
+    def outcome(self, func, *args):
+        try:
+            return func(*args)
+        except Exception as error:
+            return type(error)
+
+    def test_matches_decimal(self):
+        for entry in self.entries:
+            for spec in itertools.product(range(8),
+                                          [False, True],
+                                          [False, True],
+                                          [False, True]):
+                new = self.outcome(lambda: tablefill.format_numbers(
+                    [entry], *spec)[0])
+                old = self.outcome(decimal_format, entry, *spec)
+                self.assertEqual(new, old, (entry, spec))
+
+    def test_examples(self):
+        for entry, spec, value in [
+                ('9.995', (2, False, False, False), '10.00'),
+                ('-9.995', (2, False, False, True), '-10.00'),
+                ('999999.995', (2, False, False, True), '1,000,000.00'),
+                ('0.125', (1, True, False, False), '12.5'),
+                ('-0', (0, False, False, False), '-0'),
+                ('-0.004', (2, False, False, False), '-0.00'),
+                ('-0.004', (2, False, True, False), '0.00'),
+                ('1e3', (1, False, False, True), '1,000.0'),
+                ('-1.5e-2', (1, True, False, False), '-1.5')]:
+            self.assertEqual(tablefill.format_numbers([entry], *spec),
+                             [value], (entry, spec))
+
+    def test_many(self):
+        entries = ['1.25', '-3.5', '1e2', '7']
+        self.assertEqual(tablefill.format_numbers(entries, 1),
+                         ['1.3', '-3.5', '100.0', '7.0'])
+
+
+class TestStars(unittest.TestCase):
+
+    def engine(self, pvals, stars):
+        engine = tablefill.tablefill_internals_engine('tex',
+                                                      pvals = list(pvals),
+                                                      stars = list(stars))
+        engine.get_regexps()
+        return engine
+
+    def old_stars(self, engine, entry):
+        """How stars were picked before the thresholds were bisected"""
+        pos = sum([float(entry) < p for p in engine.pvals]) - 1
+        return '' if pos < 0 else engine.stars[pos]
+
+    def test_default(self):
+        engine = self.engine([0.1, 0.05, 0.01], ['*', '**', '***'])
+        for entry, star in [('0.2', ''), ('0.1', ''), ('0.0999', '*'),
+                            ('0.05', '*'), ('0.0499', '**'), ('0.01', '**'),
+                            ('0.0099', '***'), ('0', '***'), ('nan', '')]:
+            self.assertEqual(engine.parse_pval_to_stars('#*#', entry), star,
+                             entry)
+
+    def test_boundaries(self):
+        settings = [([0.1, 0.05, 0.01], ['*', '**', '***']),
+                    ([0.2, 0.001, 0.05], ['a', 'bb', 'ccc']),
+                    ([0.1, 0.1, 0.05], ['+', '++', '+++']),
+                    ([0.1, 0.05, 0.01, 0.001], ['*']),
+                    ([0.5], ['x'])]
+        for pvals, stars in settings:
+            engine  = self.engine(pvals, stars)
+            entries = ['0', '1', '-0.5', 'nan', '1e-05']
+            for p in pvals:
+                entries += [repr(p), repr(p - 1e-9), repr(p + 1e-9)]
+
+            for entry in entries:
+                self.assertEqual(engine.parse_pval_to_stars('#*#', entry),
+                                 self.old_stars(engine, entry),
+                                 (pvals, stars, entry))
+
+    def test_cell(self):
+        engine = self.engine([0.1, 0.05, 0.01], ['*', '**', '***'])
+        self.assertEqual(engine.parse_pval_to_stars('\\#*\\#', '0.02'),
+                         '**')
+        self.assertEqual(engine.parse_pval_to_stars('#*#', '0.02'), '**')
+
+class TestBatch(TablefillTestCase):
+
+    def jobs(self, n):
+        return [{'template': self.path('template.tex'),
+                 'output': self.path('out%d.tex' % i),
+                 'input': self.path('table.txt')} for i in range(n)]
+
+    def test_serial(self):
+        results = tablefill.tablefill_batch(jobs = self.jobs(3), silent = True)
+        self.assertEqual([r[1] for r in results], ['SUCCESS'] * 3)
+        self.assertEqual(self.body(self.read('out2.tex')), filled)
+        self.assertEqual(tablefill.batch_tables, {})
+
+    def test_processes(self):
+        results = tablefill.tablefill_batch(jobs      = self.jobs(4),
+                                            processes = 2,
+                                            silent    = True)
+        self.assertEqual([r[1] for r in results], ['SUCCESS'] * 4)
+        for i in range(4):
+            self.assertEqual(self.body(self.read('out%d.tex' % i)), filled)
+
+        self.assertEqual(tablefill.batch_tables, {})
+
+    def test_bad_input(self):
+        jobs = self.jobs(1)
+        jobs[0]['input'] = self.path('missing.txt')
+        results = tablefill.tablefill_batch(jobs = jobs, silent = True)
+        self.assertEqual(results[0][1], 'ERROR')
+
+
+custom = r"""\documentclass{article}
+%% <tablefill-python tag='custom' syntax='python'>
+%% %s
+%% </tablefill-python>
+\begin{table}
+\label{tab:custom}
+###
+\end{table}
+"""
+
+
+class TestCustomTables(TablefillTestCase):
+
+    def custom(self, expression, **kwargs):
+        exit, exit_msg, output = self.fill(custom % expression, **kwargs)
+        return exit, output.splitlines()[-2]
+
+    def test_allowed(self):
+        for expression, value in [("[test[0][1]]", '2.5'),
+                                  ("[float(test[0][1]) ** 2]", '6.25'),
+                                  ("[len(test) * 10]", '20'),
+                                  ("[sorted(other[0])[0].strip()]", '0.001'),
+                                  ("[(3 ** 2 + 4 ** 2) ** 0.5]", '5.0')]:
+            exit, line = self.custom(expression)
+            self.assertEqual((exit, line), ('SUCCESS', value), expression)
+
+    def test_rejected(self):
+        for expression in ["[__import__('os').getcwd()]",
+                           "[test.__class__]",
+                           "[open('table.txt').read()]",
+                           "[(lambda: 1)()]",
+                           "[test[0][0].format]",
+                           "[9 ** 9 ** 9]",
+                           "[((9 ** 64) ** 64) ** 64]",
+                           "[2 ** len(test)]"]:
+            exit, line = self.custom(expression)
+            self.assertEqual((exit, line), ('WARNING', '###'), expression)
+
+    def test_compile(self):
+        code, names = tablefill.compile_custom_table('[test[0][0]]')
+        self.assertEqual(names, set(['test']))
+        self.assertIs(tablefill.compile_custom_table('[test[0][0]]')[0],
+                      code)
+        self.assertRaises(SyntaxError, tablefill.compile_custom_table,
+                          '[xforxintest]if0else__import__')
+        self.assertRaises(SyntaxError, tablefill.compile_custom_table,
+                          '[2**test]')
+
+    def test_cache_has_no_code(self):
+        cache = self.path('cache')
+        exit, line = self.custom("[test[0][1]]", cache = cache)
+        self.assertEqual((exit, line), ('SUCCESS', '2.5'))
+        self.assertEqual([f for f in listdir(cache) if f.endswith('.code')],
+                         [])
+
+
+ordered = r"""\documentclass{article}
+%% <tablefill-python tag='%s' syntax='python'>
+%% %s
+%% </tablefill-python>
+%% <tablefill-python tag='%s' syntax='python'>
+%% %s
+%% </tablefill-python>
+\begin{table}
+\label{tab:%s}
+###
+\end{table}
+\begin{table}
+\label{tab:%s}
+###
+\end{table}
+\begin{table}
+\label{tab:test}
+#2#
+\end{table}
+"""
+
+
+class TestCustomTableOrder(TablefillTestCase):
+
+    def fill_two(self, a, atext, b, btext):
+        text = ordered % (a, atext, b, btext, a, b)
+        exit, exit_msg, output = self.fill(text)
+        return exit, output.splitlines()
+
+    def test_order(self):
+        # 'a' uses 'b', which comes after it in the template
+        exit, lines = self.fill_two('a', "[b[0]]", 'b', "[other[0][1]]")
+        self.assertEqual(exit, 'SUCCESS')
+        self.assertEqual(lines[-10], '0.001')
+        self.assertEqual(lines[-6], '0.001')
+        self.assertEqual(lines[-2], '1.23')
+
+    def test_attribute_is_not_a_dependency(self):
+        # 'b' calls .strip(); only 'strip' uses another table
+        exit, lines = self.fill_two('strip', "[b[0]]",
+                                    'b', "[test[1][2].strip()]")
+        self.assertEqual(exit, 'SUCCESS')
+        self.assertEqual(lines[-10], 'foo')
+        self.assertEqual(lines[-6], 'foo')
+
+    def test_cycle(self):
+        exit, lines = self.fill_two('a', "b", 'b', "a")
+        self.assertEqual(exit, 'WARNING')
+        self.assertEqual(lines[-10], '###')
+        self.assertEqual(lines[-6], '###')
+        self.assertEqual(lines[-2], '1.23')
+
+    def test_empty(self):
+        text = ordered % ('a', "", 'b', "[test[0][0]]", 'a', 'b')
+        text = text.replace("'python'>\n% \n% </", "'python'></")
+        exit, exit_msg, output = self.fill(text)
+        lines = output.splitlines()
+        self.assertEqual(exit, 'WARNING')
+        self.assertEqual(lines[-10], '###')
+        self.assertEqual(lines[-6], '1.2345')
+        self.assertEqual(lines[-2], '1.23')
+
+    def test_table_order(self):
+        order, cycle = tablefill.custom_table_order({
+            'c': set(['b', 'test']),
+            'b': set(['a']),
+            'a': set(['a']),
+            'x': set(['y']),
+            'y': set(['x']),
+            'z': set(['x'])})
+        self.assertEqual(order, ['a', 'b', 'c'])
+        self.assertEqual(cycle, ['x', 'y', 'x'])
+
+
+class TestFillPlanCache(TablefillTestCase):
+
+    def setUp(self):
+        super(TestFillPlanCache, self).setUp()
+        self.cache = self.path('cache')
+        self.slots = 0
+        engine     = tablefill.tablefill_internals_engine
+        self.get_line_slots = engine.get_line_slots
+
+        def get_line_slots(engine, line):
+            self.slots += 1
+            return self.get_line_slots(engine, line)
+
+        engine.get_line_slots = get_line_slots
+
+    def tearDown(self):
+        engine = tablefill.tablefill_internals_engine
+        engine.get_line_slots = self.get_line_slots
+        super(TestFillPlanCache, self).tearDown()
+
+    def plans(self):
+        return sorted(f for f in listdir(self.cache) if f.endswith('.plan'))
+
+    def test_reused(self):
+        exit, exit_msg, output = self.fill(cache = self.cache)
+        self.assertEqual(exit, 'SUCCESS', exit_msg)
+        self.assertEqual(self.slots, 3)
+        plans = self.plans()
+        self.assertEqual(len(plans), 1)
+
+        exit, exit_msg, output = self.fill(cache = self.cache)
+        self.assertEqual(self.body(output), filled)
+        self.assertEqual(self.slots, 3)
+        self.assertEqual(self.plans(), plans)
+
+    def test_template_changed(self):
+        self.fill(cache = self.cache)
+        plans = self.plans()
+
+        changed = template.replace('#2# #*#', '#3# #*#')
+        exit, exit_msg, output = self.fill(changed, cache = self.cache)
+        self.assertEqual(exit, 'SUCCESS', exit_msg)
+        self.assertEqual(self.body(output),
+                         filled.replace('0.20 ***', '0.200 ***'))
+        self.assertEqual(self.slots, 6)
+        self.assertEqual(len(self.plans()), 2)
+        self.assertTrue(set(plans) < set(self.plans()))
+
+    def test_inputs_changed(self):
+        self.fill(cache = self.cache)
+        self.write('table.txt', table.replace('0.2\t', '0.7\t'))
+        exit, exit_msg, output = self.fill(cache = self.cache)
+        self.assertEqual(exit, 'SUCCESS', exit_msg)
+        self.assertEqual(self.body(output),
+                         filled.replace('0.20 ***', '0.70 ***'))
+        self.assertEqual(self.slots, 3)
+        self.assertEqual(len(self.plans()), 1)
+
+    def test_capped(self):
+        cache_max_files = tablefill.cache_max_files
+        tablefill.cache_max_files = 1
+        try:
+            self.fill(cache = self.cache)
+            plans = self.plans()
+            changed = template.replace('#2# #*#', '#3# #*#')
+            exit, exit_msg, output = self.fill(changed, cache = self.cache)
+        finally:
+            tablefill.cache_max_files = cache_max_files
+
+        self.assertEqual(exit, 'SUCCESS', exit_msg)
+        self.assertEqual(len(listdir(self.cache)), 1)
+        self.assertEqual(len(self.plans()), 1)
+        self.assertNotEqual(self.plans(), plans)
+
+    def test_corrupt_plan(self):
+        self.fill(cache = self.cache)
+        self.write(path.join('cache', self.plans()[0]), '')
+        exit, exit_msg, output = self.fill(cache = self.cache)
+        self.assertEqual(exit, 'SUCCESS', exit_msg)
+        self.assertEqual(self.body(output), filled)
+        self.assertEqual(self.slots, 6)
+
+
+class TestIncremental(TablefillTestCase):
+
+    def setUp(self):
+        super(TestIncremental, self).setUp()
+        self.write('other.txt', table.replace('0.2\t', '0.7\t'))
+        self.fill(incremental = True)
+        self.fill(input = self.path('other.txt'), output = 'other.tex',
+                  incremental = True)
+        for fname in ['output.tex', 'other.tex']:
+            utime(self.path(fname), (1000, 1000))
+
+    def mtime(self, fname):
+        return stat(self.path(fname)).st_mtime
+
+    def test_unchanged(self):
+        exit, exit_msg, output = self.fill(incremental = True)
+        self.assertEqual(exit, 'SUCCESS', exit_msg)
+        self.assertEqual(self.body(output), filled)
+        self.assertEqual(self.mtime('output.tex'), 1000)
+
+    def test_changed_input(self):
+        self.write('table.txt', table.replace('0.2\t', '0.9\t'))
+        for fname in ['output.tex', 'other.tex']:
+            inputs = 'table.txt' if fname == 'output.tex' else 'other.txt'
+            exit, exit_msg, output = self.fill(input = self.path(inputs),
+                                               output = fname,
+                                               incremental = True)
+            self.assertEqual(exit, 'SUCCESS', exit_msg)
+
+        self.assertEqual(self.body(self.read('output.tex')),
+                         filled.replace('0.20 ***', '0.90 ***'))
+        self.assertNotEqual(self.mtime('output.tex'), 1000)
+        self.assertEqual(self.body(self.read('other.tex')),
+                         filled.replace('0.20 ***', '0.70 ***'))
+        self.assertEqual(self.mtime('other.tex'), 1000)
+
+    def test_missing_manifest(self):
+        remove(self.path('.output.tex.manifest'))
+        self.write('table.txt', table.replace('1.2345', '9.8765'))
+        exit, exit_msg, output = self.fill(incremental = True)
+        self.assertEqual(exit, 'SUCCESS', exit_msg)
+        self.assertEqual(self.body(output), filled.replace('1.23', '9.88'))
+        self.assertTrue(path.isfile(self.path('.output.tex.manifest')))
+
+    def test_corrupt_manifest(self):
+        self.write('.output.tex.manifest', 'not a manifest')
+        self.write('table.txt', table.replace('1.2345', '9.8765'))
+        exit, exit_msg, output = self.fill(incremental = True)
+        self.assertEqual(exit, 'SUCCESS', exit_msg)
+        self.assertEqual(self.body(output), filled.replace('1.23', '9.88'))
+
+        exit, exit_msg, output = self.fill(incremental = True)
+        self.assertEqual(self.body(output), filled.replace('1.23', '9.88'))
+        self.assertNotEqual(self.read('.output.tex.manifest'),
+                            'not a manifest')
+
+    def test_symlink(self):
+        mkdir(self.path('real'))
+        symlink(self.path(path.join('real', 'output.tex')),
+                self.path('link.tex'))
+        for incremental in [False, True]:
+            exit, exit_msg, output = self.fill(output = 'link.tex',
+                                               incremental = incremental)
+            self.assertEqual(exit, 'SUCCESS', exit_msg)
+            self.assertTrue(path.islink(self.path('link.tex')))
+            self.assertEqual(self.body(self.read('real/output.tex')),
+                             filled)
+            self.assertEqual([f for f in listdir(self.path('real'))
+                              if f.startswith('.tmp')], [])
+
+
+class TestInputCache(TablefillTestCase):
+
+    def setUp(self):
+        super(TestInputCache, self).setUp()
+        self.cache = self.path('cache')
+        self.cache_max_files = tablefill.cache_max_files
+        tablefill.cache_max_files = 3
+
+    def tearDown(self):
+        tablefill.cache_max_files = self.cache_max_files
+        super(TestInputCache, self).tearDown()
+
+    def load(self, n):
+        self.write('table%d.txt' % n, '<tab:test>\n%d\n' % n)
+        infiles = [self.path('table%d.txt' % n)]
+        self.assertEqual(tablefill.load_input_tables(infiles, self.cache),
+                         {'test': [[str(n)]]})
+
+    def cached(self):
+        return sorted(f for f in listdir(self.cache)
+                      if f.endswith('.marshal'))
+
+    def test_evicts_least_recently_used(self):
+        names = []
+        for n in range(3):
+            self.load(n)
+            names += set(self.cached()) - set(names)
+            utime(path.join(self.cache, names[n]), (1000, 1000 + n))
+
+        # Table 0 is the oldest, but loading it again makes it the newest
+        self.write(path.join('cache', 'notes.txt'), 'kept')
+        self.load(0)
+        self.load(3)
+        cached = self.cached()
+        self.assertEqual(len(cached), 3)
+        self.assertIn(names[0], cached)
+        self.assertNotIn(names[1], cached)
+        self.assertIn(names[2], cached)
+        self.assertEqual(self.read(path.join('cache', 'notes.txt')), 'kept')
+
+    def test_permissions(self):
+        self.load(0)
+        cachefile = path.join(self.cache, self.cached()[0])
+        self.assertEqual(stat(cachefile).st_mode & 0o777,
+                         0o666 & ~tablefill.file_umask)
+        self.assertEqual([f for f in listdir(self.cache)
+                          if f.startswith('.tmp')], [])
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class TestNumpyInputs(TablefillTestCase):
+
+    def test_npz(self):
+        numpy.savez(self.path('tables.npz'),
+                    test  = numpy.array([[1.2345, 2.5, 0.03],
+                                         [1234567.891, -0.5, 0]]),
+                    other = numpy.array([0.2, 0.001]))
+        tables = tablefill.parse_input_tables([self.path('tables.npz')])
+        self.assertEqual(tables['test'][0], ['1.2345', '2.5', '0.03'])
+        self.assertEqual(tables['other'], [['0.2', '0.001']])
+
+        exit, exit_msg, output = self.fill(input = self.path('tables.npz'))
+        self.assertEqual(exit, 'SUCCESS', exit_msg)
+        self.assertEqual(self.body(output),
+                         filled.replace('& foo', '& 0.0'))
+
+    def test_npz_is_closed(self):
+        numpy.savez(self.path('tables.npz'), test = numpy.ones((2, 2)))
+        loaded = []
+
+        def load(*args, **kwargs):
+            loaded.append(numpy_load(*args, **kwargs))
+            return loaded[-1]
+
+        numpy_load = numpy.load
+        numpy.load = load
+        try:
+            tablefill.parse_input_tables([self.path('tables.npz')])
+        finally:
+            numpy.load = numpy_load
+
+        self.assertEqual(len(loaded), 1)
+        self.assertIsNone(loaded[0].fid)
+
+    def test_npy(self):
+        array = numpy.arange(24.0).reshape(2, 3, 4)
+        numpy.save(self.path('Cube.npy'), array)
+        tables = tablefill.parse_input_tables([self.path('Cube.npy')])
+        self.assertEqual(list(tables.keys()), ['cube'])
+        self.assertEqual(len(tables['cube']), 2)
+        self.assertEqual(tables['cube'][1][0], '12.0')
+        self.assertEqual(len(tables['cube'][1]), 12)
+
+    def test_npy_cache(self):
+        # Same contents, but tagged with different file names
+        cache = self.path('cache')
+        numpy.save(self.path('alpha.npy'), numpy.array([[1.5]]))
+        numpy.save(self.path('beta.npy'), numpy.array([[1.5]]))
+        alpha = tablefill.load_input_tables([self.path('alpha.npy')], cache)
+        beta  = tablefill.load_input_tables([self.path('beta.npy')], cache)
+        self.assertEqual(alpha, {'alpha': [['1.5']]})
+        self.assertEqual(beta, {'beta': [['1.5']]})
+
+    def test_mixed(self):
+        numpy.save(self.path('other.npy'), numpy.array([[5.5]]))
+        infiles = [self.path('table.txt'), self.path('other.npy')]
+        tables  = tablefill.parse_input_tables(infiles)
+        self.assertEqual(tables['test'][1][2], 'foo')
+        self.assertEqual(tables['other'], [['5.5']])
+
+
+if __name__ == '__main__':
+    unittest.main()